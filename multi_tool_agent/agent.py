@@ -3,7 +3,11 @@
 
 import os
 import sys
+import asyncio
 import logging
+import threading
+import time
+from dataclasses import dataclass
 from google.adk.agents import LlmAgent, Agent
 from dotenv import load_dotenv
 load_dotenv()
@@ -18,7 +22,7 @@ try:
     from bta_agent import bta_agent, trigger_build_and_monitor
     from da_agent import da_agent, deploy_to_cloud_run, get_latest_deployed_image, get_service_details
     from mda_agent import mda_agent, get_cloud_run_metrics, get_cloud_run_logs, generate_health_report
-    from finops_agent import finops_agent, get_total_project_cost, get_cost_by_service
+    from finops_agent import finops_agent, get_total_project_cost, get_cost_by_service, get_cost_summary
     from secops_agent import secops_agent, get_vulnerability_scan_results, summarize_vulnerabilities_with_gemini
     from rollback_agent import rollback_agent, get_previous_stable_revision, redirect_traffic_to_revision
     from infra_agent import infra_agent, run_terraform_plan, run_terraform_apply
@@ -42,6 +46,7 @@ except ImportError as e:
     def generate_health_report(**kwargs): return "Error: MDA module not found."
     def get_total_project_cost(**kwargs): return {"status": "ERROR", "error_message": "FinOps module not found."}
     def get_cost_by_service(**kwargs): return {"status": "ERROR", "error_message": "FinOps module not found."}
+    def get_cost_summary(**kwargs): return {"status": "ERROR", "error_message": "FinOps module not found."}
     def get_vulnerability_scan_results(**kwargs): return {"status": "ERROR", "error_message": "Security module not found."}
     def summarize_vulnerabilities_with_gemini(**kwargs): return "Error: Security module not found."
     def get_previous_stable_revision(**kwargs): return {"status": "ERROR", "error_message": "Rollback module not found."}
@@ -62,43 +67,30 @@ TARGET_APP_CLOUD_RUN_REGION = os.getenv("TARGET_APP_CLOUD_RUN_REGION", "us-centr
 TARGET_APP_CLOUD_RUN_SERVICE_NAME = os.getenv("TARGET_APP_CLOUD_RUN_SERVICE_NAME", "geminiflow-hello-world-svc")
 INFRA_DEFAULT_IMAGE_REPO = os.getenv("ARTIFACT_REGISTRY_REPO", "gemini-flow-apps")
 INFRA_DEFAULT_IMAGE_NAME = "gemini-flow-hello-world"
+# Image used when a plan or apply asks for "latest"; every part is fixed once the environment is loaded.
+INFRA_DEFAULT_IMAGE_URI = (
+    f"{TARGET_APP_CLOUD_RUN_REGION}-docker.pkg.dev/{GCP_PROJECT_ID}/"
+    f"{INFRA_DEFAULT_IMAGE_REPO}/{INFRA_DEFAULT_IMAGE_NAME}:latest"
+)
+
+@dataclass(frozen=True, slots=True)
+class AppConfig:
+    """Deployment settings for an application the smart deploy workflow can release."""
+    repo_full_name: str
+    trigger_id: str
+    cloud_run_region: str
+    cloud_run_service: str
+
+# Deployable applications keyed by lower-case repository name (without the owner prefix).
+_APP_REGISTRY: dict[str, AppConfig] = {
+    TARGET_GITHUB_REPO_FULL_NAME.split('/')[-1].lower(): AppConfig(
+        repo_full_name=TARGET_GITHUB_REPO_FULL_NAME,
+        trigger_id=TARGET_APP_TRIGGER_ID,
+        cloud_run_region=TARGET_APP_CLOUD_RUN_REGION,
+        cloud_run_service=TARGET_APP_CLOUD_RUN_SERVICE_NAME,
+    ),
+}
 
-def execute_rollback_workflow(service_id: str, location: str) -> str:
-    """
-    Executes a full rollback workflow for a given service.
-    """
-    logging.warning(f"MOA Tool (Rollback): Initiating rollback for service '{service_id}' in '{location}'.")
-    
-    # Step 1: Find the revision to roll back to
-    stable_rev_report = get_previous_stable_revision(
-        project_id=GCP_PROJECT_ID,
-        location=location,
-        service_id=service_id
-    )
-    if stable_rev_report.get("status") != "SUCCESS":
-        error_msg = f"Rollback FAILED: Could not identify a previous stable revision. Reason: {stable_rev_report.get('error_message')}"
-        logging.error(error_msg)
-        return error_msg
-        
-    revision_to_restore = stable_rev_report.get("previous_stable_revision_name")
-    
-    # Step 2: Redirect traffic
-    redirect_report = redirect_traffic_to_revision(
-        project_id=GCP_PROJECT_ID,
-        location=location,
-        service_id=service_id,
-        revision_name=revision_to_restore
-    )
-    
-    if redirect_report.get("status") == "SUCCESS":
-        success_msg = f"Rollback SUCCESS: Traffic for '{service_id}' has been redirected to previous stable revision '{revision_to_restore.split('/')[-1]}'."
-        logging.info(success_msg)
-        return success_msg
-    else:
-        error_msg = f"Rollback FAILED: Attempted to redirect traffic, but failed. Reason: {redirect_report.get('error_message')}"
-        logging.error(error_msg)
-        return error_msg
-    
 def plan_new_environment(
     new_service_name: str,
     image_uri_to_deploy: str = "latest",
@@ -113,10 +105,7 @@ def plan_new_environment(
 
     final_image_uri = ""
     if image_uri_to_deploy.lower() == "latest":
-        final_image_uri = (
-            f"{TARGET_APP_CLOUD_RUN_REGION}-docker.pkg.dev/{GCP_PROJECT_ID}/"
-            f"{INFRA_DEFAULT_IMAGE_REPO}/{INFRA_DEFAULT_IMAGE_NAME}:latest"
-        )
+        final_image_uri = INFRA_DEFAULT_IMAGE_URI
         print(f"📦 Using default image URI: {final_image_uri}")
         logging.info(f"MOA Tool (Infra Plan): Using default image URI: {final_image_uri}")
     else:
@@ -225,10 +214,7 @@ def apply_new_environment(
     
     final_image_uri = ""
     if image_uri_to_deploy.lower() == "latest":
-        final_image_uri = (
-            f"{TARGET_APP_CLOUD_RUN_REGION}-docker.pkg.dev/{GCP_PROJECT_ID}/"
-            f"{INFRA_DEFAULT_IMAGE_REPO}/{INFRA_DEFAULT_IMAGE_NAME}:latest"
-        )
+        final_image_uri = INFRA_DEFAULT_IMAGE_URI
     else:
         final_image_uri = image_uri_to_deploy
 
@@ -290,6 +276,35 @@ def apply_new_environment(
 
     return "".join(response_parts)
 
+# --- Build Result Cache ---
+# Successful BTA reports keyed by (repository, commit SHA). Re-deploying a commit that was
+# built moments ago reuses its image instead of running the whole Cloud Build again.
+DEPLOY_CACHE_TTL_SECONDS = int(os.getenv("DEPLOY_CACHE_TTL_SECONDS", "600"))
+_BUILD_CACHE: dict[tuple[str, str], tuple[float, dict]] = {}
+_BUILD_CACHE_LOCK = threading.Lock()
+
+def _get_cached_build(repo_full_name: str, commit_sha: str) -> dict | None:
+    """Returns a still-fresh successful BTA report for the commit, if one is cached."""
+    key = (repo_full_name, commit_sha)
+    with _BUILD_CACHE_LOCK:
+        entry = _BUILD_CACHE.get(key)
+        if entry is None:
+            return None
+        stored_at, bta_report = entry
+        if time.monotonic() - stored_at > DEPLOY_CACHE_TTL_SECONDS:
+            del _BUILD_CACHE[key]
+            return None
+        return bta_report
+
+def _cache_build(repo_full_name: str, commit_sha: str, bta_report: dict) -> None:
+    """Records a successful BTA report for the commit."""
+    with _BUILD_CACHE_LOCK:
+        _BUILD_CACHE[(repo_full_name, commit_sha)] = (time.monotonic(), bta_report)
+
+def _report_msg(report: dict) -> str:
+    """Returns the human-readable outcome of a sub-agent report."""
+    return report.get("message") or report.get("error_message") or "No details"
+
 # --- MOA Tool Definitions ---
 def execute_smart_deploy_workflow(
     target_repository_name: str,
@@ -305,11 +320,17 @@ def execute_smart_deploy_workflow(
     final_summary = []
     deployment_url = None  # Initialize deployment URL variable
 
+    app = _APP_REGISTRY.get(target_repository_name.split('/')[-1].lower())
+    if app is None:
+        supported = ", ".join(sorted(_APP_REGISTRY))
+        print(f"❌ '{target_repository_name}' is not a supported application.")
+        return f"Deployment target '{target_repository_name}' is not a supported application. Supported applications: {supported}."
+
     # Step 1: Source Control
     print("🔍 Step 1/6: Retrieving latest commit information...")
     logging.info("MOA Tool (Smart Deploy): [Step 1/6] Calling SCA logic...")
-    sca_report = get_latest_commit_sha(repo_full_name=TARGET_GITHUB_REPO_FULL_NAME, branch_name=target_branch_name)
-    final_summary.append(f"1. SCA Report: {sca_report.get('message', sca_report.get('error_message'))}")
+    sca_report = get_latest_commit_sha(repo_full_name=app.repo_full_name, branch_name=target_branch_name)
+    final_summary.append(f"1. SCA Report: {_report_msg(sca_report)}")
     if sca_report.get("status") != "SUCCESS":
         print("❌ Source control check failed!")
         return "\n".join(final_summary)
@@ -318,12 +339,19 @@ def execute_smart_deploy_workflow(
 
     # Step 2: Build & Test
     print("🔨 Step 2/6: Starting build and test process...")
-    logging.info("MOA Tool (Smart Deploy): [Step 2/6] Calling BTA logic...")
-    bta_report = trigger_build_and_monitor(
-        trigger_id=TARGET_APP_TRIGGER_ID, project_id=GCP_PROJECT_ID,
-        repo_name=TARGET_GITHUB_REPO_FULL_NAME.split('/')[-1], branch_name=target_branch_name, commit_sha=commit_sha
-    )
-    final_summary.append(f"2. BTA Report: {bta_report.get('message', bta_report.get('error_message'))}")
+    bta_report = _get_cached_build(app.repo_full_name, commit_sha)
+    if bta_report is not None:
+        print(f"♻️ Reusing the recent successful build of commit {commit_sha[:8]}...")
+        logging.info(f"MOA Tool (Smart Deploy): [Step 2/6] Reusing cached BTA report for commit '{commit_sha}'.")
+    else:
+        logging.info("MOA Tool (Smart Deploy): [Step 2/6] Calling BTA logic...")
+        bta_report = trigger_build_and_monitor(
+            trigger_id=app.trigger_id, project_id=GCP_PROJECT_ID,
+            repo_name=app.repo_full_name.split('/')[-1], branch_name=target_branch_name, commit_sha=commit_sha
+        )
+        if bta_report.get("status") == "SUCCESS":
+            _cache_build(app.repo_full_name, commit_sha, bta_report)
+    final_summary.append(f"2. BTA Report: {_report_msg(bta_report)}")
     test_summary = bta_report.get("test_results", {}).get("failure_summary", "Tests not processed.")
     final_summary.append(f"   Test Status: {test_summary}")
     if bta_report.get("status") != "SUCCESS":
@@ -376,8 +404,8 @@ def execute_smart_deploy_workflow(
     logging.info("MOA Tool (Smart Deploy): [Step 4/6] Calling DA logic...")
     image_uri_commit = bta_report.get("image_uri_commit")
     da_report = deploy_to_cloud_run(
-        project_id=GCP_PROJECT_ID, region=TARGET_APP_CLOUD_RUN_REGION,
-        service_name=TARGET_APP_CLOUD_RUN_SERVICE_NAME, image_uri=image_uri_commit
+        project_id=GCP_PROJECT_ID, region=app.cloud_run_region,
+        service_name=app.cloud_run_service, image_uri=image_uri_commit
     )
     
     # MODIFIED: Handle deployment failure with automatic rollback
@@ -387,8 +415,8 @@ def execute_smart_deploy_workflow(
         
         # Attempt automatic rollback
         rollback_summary = execute_rollback_workflow(
-            service_id=TARGET_APP_CLOUD_RUN_SERVICE_NAME,
-            location=TARGET_APP_CLOUD_RUN_REGION
+            service_id=app.cloud_run_service,
+            location=app.cloud_run_region
         )
         
         deployment_failure_message = da_report.get('error_message', 'Unknown deployment error')
@@ -405,15 +433,15 @@ def execute_smart_deploy_workflow(
     if deployment_url:
         print(f"🌐 Service deployed at: {deployment_url}")
     
-    final_summary.append(f"4. Deployment: {da_report.get('message', da_report.get('error_message'))}")
+    final_summary.append(f"4. Deployment: {_report_msg(da_report)}")
     print("✅ Deployment completed successfully!")
 
     # Step 5: Post-Deployment Health Check
     print("🏥 Step 5/6: Running post-deployment health check...")
     logging.info("MOA Tool (Smart Deploy): [Step 5/6] Performing post-deployment health check...")
     health_check_raw_data = execute_health_check_workflow(
-        service_id=TARGET_APP_CLOUD_RUN_SERVICE_NAME,
-        location=TARGET_APP_CLOUD_RUN_REGION,
+        service_id=app.cloud_run_service,
+        location=app.cloud_run_region,
         time_window_minutes=5 # Check a short window right after deployment
     )
     
@@ -424,8 +452,8 @@ def execute_smart_deploy_workflow(
         logging.warning("Deployment appears unhealthy, initiating automated rollback.")
         
         rollback_summary = execute_rollback_workflow(
-            service_id=TARGET_APP_CLOUD_RUN_SERVICE_NAME,
-            location=TARGET_APP_CLOUD_RUN_REGION
+            service_id=app.cloud_run_service,
+            location=app.cloud_run_region
         )
         final_summary.append(f"   🔄 Automatic Rollback: {rollback_summary}")
         final_summary.append("")
@@ -448,6 +476,60 @@ def execute_smart_deploy_workflow(
     
     return "\n".join(final_summary)
 
+async def execute_smart_deploy_workflow_batch(targets: list[dict]) -> str:
+    """
+    Runs the smart deploy workflow for several repository/branch targets concurrently.
+    Each target is a dict with 'repository' and 'branch' keys.
+    """
+    print(f"🚀 Starting batch deployment for {len(targets)} target(s)...")
+    logging.info(f"MOA Tool (Smart Deploy Batch): Initiating for {len(targets)} targets.")
+
+    # Every target for an app rolls out (and may roll back) the same Cloud Run service, so two
+    # targets resolving to one app - another branch, or the repository with its owner prefix -
+    # would race on it. Only the first target per app runs; the rest are reported as skipped.
+    keys = []
+    for target in targets:
+        repo_name = target.get("repository", "").split('/')[-1].lower()
+        app = _APP_REGISTRY.get(repo_name)
+        keys.append((app.cloud_run_region, app.cloud_run_service) if app else repo_name)
+    first_index_by_app: dict[tuple[str, str] | str, int] = {}
+    for index, key in enumerate(keys):
+        first_index_by_app.setdefault(key, index)
+
+    # Each workflow is blocking I/O end to end, so run them on worker threads side by side.
+    results = await asyncio.gather(
+        *[
+            asyncio.to_thread(
+                execute_smart_deploy_workflow,
+                target_repository_name=targets[index].get("repository", ""),
+                target_branch_name=targets[index].get("branch", "main"),
+            )
+            for index in first_index_by_app.values()
+        ],
+        return_exceptions=True,
+    )
+    results_by_app = dict(zip(first_index_by_app.keys(), results))
+
+    report_parts = []
+    for index, (target, key) in enumerate(zip(targets, keys)):
+        header = f"=== {target.get('repository', '')} ({target.get('branch', 'main')}) ==="
+        first = targets[first_index_by_app[key]]
+        if first_index_by_app[key] != index:
+            report_parts.append(
+                f"{header}\nSkipped: {first.get('repository', '')} ({first.get('branch', 'main')}) "
+                "already deploys this application in this batch."
+            )
+            continue
+        result = results_by_app[key]
+        # A cancelled workflow thread surfaces as CancelledError, which is a BaseException only.
+        if isinstance(result, BaseException):
+            logging.error(f"MOA Tool (Smart Deploy Batch): Workflow for {target} raised: {result!r}")
+            result = f"Workflow FAILED with an unexpected error: {str(result) or type(result).__name__}"
+        report_parts.append(f"{header}\n{result}")
+
+    print("🎉 Batch deployment workflow completed!")
+    return "\n\n".join(report_parts)
+
 def execute_health_check_workflow(
     service_id: str, location: str, time_window_minutes: int = 15, max_log_entries: int = 5
 ) -> str:
@@ -479,17 +561,17 @@ def execute_finops_report_workflow(
     print("📊 Gathering billing data...")
     
     logging.info(f"MOA Tool (FinOps): Initiating cost report for the last {days_ago} days.")
-    total_cost_report = get_total_project_cost(days_ago=days_ago)
-    cost_by_service_report = get_cost_by_service(days_ago=days_ago)
+    # One fused query answers both the total and the per-service breakdown.
+    cost_summary_report = get_cost_summary(days_ago=days_ago)
     
     print("📋 Generating cost report...")
     report_parts = [f"FinOps Report Data (last {days_ago} days):\n"]
-    if total_cost_report.get("status") == "SUCCESS":
-        report_parts.append(f"Total Cost: {total_cost_report.get('total_cost', 'N/A')}")
+    if cost_summary_report.get("status") == "SUCCESS":
+        report_parts.append(f"Total Cost: {cost_summary_report.get('total_cost', 'N/A')}")
     else:
-        report_parts.append(f"Total Cost: Error - {total_cost_report.get('error_message')}")
-    if cost_by_service_report.get("status") == "SUCCESS":
-        cost_breakdown = cost_by_service_report.get('cost_breakdown', [])
+        report_parts.append(f"Total Cost: Error - {cost_summary_report.get('error_message')}")
+    if cost_summary_report.get("status") == "SUCCESS":
+        cost_breakdown = cost_summary_report.get('cost_breakdown', [])
         report_parts.append("\nTop Services by Cost:")
         if cost_breakdown:
             for service in cost_breakdown:
@@ -497,10 +579,11 @@ def execute_finops_report_workflow(
         else:
             report_parts.append("  - No cost data found for services.")
     else:
-        report_parts.append(f"\nTop Services by Cost: Error - {cost_by_service_report.get('error_message')}")
+        report_parts.append(f"\nTop Services by Cost: Error - {cost_summary_report.get('error_message')}")
     
     print("✅ Cost analysis completed!")
     return "\n".join(report_parts)
+
 def execute_rollback_workflow(service_id: str, location: str) -> str:
     """
     Executes a full rollback workflow for a given service.
@@ -557,6 +640,7 @@ root_agent = LlmAgent(
         "You are the Master Orchestrator for a DevSecOps system called GeminiFlow. "
         "You have specialized sub-agents. Your primary roles are to manage secure deployments, provide health checks, and provision new infrastructure. "
         "\n1. For DEPLOYMENTS: When a user asks to deploy an application, this includes a security scan. Use the 'execute_smart_deploy_workflow' tool. "
+        "If the user asks to deploy multiple apps, call 'execute_smart_deploy_workflow_batch' once with the list of targets rather than issuing multiple tool calls. "
         "\n2. For HEALTH CHECKS: When a user asks for the health or status of a service, use the 'execute_health_check_workflow' tool and summarize the raw data it returns."
         "\n3. For INFRASTRUCTURE PROVISIONING: This is a two-step process. "
         "  a. First, when a user asks to 'plan' or 'provision' a new environment (e.g., 'plan a new staging service named staging-v2'), "
@@ -570,6 +654,7 @@ root_agent = LlmAgent(
     ),
     tools=[
         execute_smart_deploy_workflow,
+        execute_smart_deploy_workflow_batch,
         execute_health_check_workflow,
         execute_finops_report_workflow,
         execute_rollback_workflow,
@@ -1,18 +1,23 @@
 # bta_agent.py
 
 import os
+import io
+import re
 import logging
 import json
 import time
+import hashlib
+import threading
+from collections import OrderedDict
+from collections.abc import Iterable
 from google.adk.agents import Agent # Or LlmAgent if BTA directly uses an LLM for complex tasks
 from google.cloud.devtools import cloudbuild_v1
 from google.cloud import storage
-from google.protobuf.json_format import MessageToDict
-import google.generativeai as genai # For calling Gemini API directly
+from google.api_core import exceptions as api_exceptions
 from dotenv import load_dotenv
 load_dotenv()
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 
 # --- Configuration ---
@@ -25,94 +30,240 @@ IMAGE_NAME = "gemini-flow-hello-world"
 TEST_RESULTS_BUCKET_NAME = os.getenv("TEST_RESULTS_BUCKET_NAME", "your-project-id-geminiflow-build-artifacts") # REPLACE
 GEMINI_MODEL_NAME = "gemini-2.0-flash"
 VERTEX_AI_LOCATION = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
+TEST_STEP_ID = os.getenv("BTA_TEST_STEP_ID", "run-tests") # Build step id that runs the test suite
+SUMMARY_CACHE_SIZE = 256
+MAX_PROMPT_LOG_CHARS = 4000 # Roughly 1k tokens of build log per summary prompt
+MAX_SUMMARIZED_FAILURES = 20
+MAX_FAILURE_PROMPT_CHARS = 8000
+MAX_SUMMARY_OUTPUT_TOKENS = 512
+BUILD_POLL_INITIAL_SECONDS = 1.0
+BUILD_POLL_MAX_SECONDS = 15.0
+ARTIFACT_READ_CHUNK_SIZE = 4 * 1024 * 1024 # Bytes fetched per ranged read when streaming artifacts
+MAX_BUILD_LOG_BYTES = int(os.getenv("BTA_MAX_BUILD_LOG_BYTES", "8192")) # Log bytes (head and tail) fetched for summaries
+# Everything but the project and tag is fixed once the environment is loaded.
+IMAGE_URI_TEMPLATE = f"{ARTIFACT_REGISTRY_LOCATION}-docker.pkg.dev/{{project_id}}/{ARTIFACT_REGISTRY_REPO}/{IMAGE_NAME}:{{tag}}"
 
-def _download_gcs_artifact(bucket_name: str, object_name: str) -> str | None:
-    try:
-        storage_client = storage.Client(project=GCP_PROJECT_ID)
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(object_name)
-        logging.info(f"BTA: Checking for artifact in GCS: bucket={bucket_name}, object={object_name}")
-        if not blob.exists():
-            logging.warning(f"BTA: Artifact not found in GCS: gs://{bucket_name}/{object_name}")
+# Response field mask for status polls, so in-progress builds don't return their full step list.
+_STATUS_ONLY_METADATA = (("x-goog-fieldmask", "status"),)
+_ANSI_ESCAPE_RE = re.compile(rb"\x1b\[[0-9;]*[A-Za-z]")
+# Per-test framing lines from 'go test -json' output; they name the test and its duration.
+_GO_TEST_FRAMING_RE = re.compile(r"^\s*(?:=== (?:RUN|PAUSE|CONT|NAME)|--- (?:FAIL|PASS|SKIP):)\s.*\n?", re.MULTILINE)
+
+# --- Shared Clients ---
+# Constructing a client re-runs credential discovery and opens new channels,
+# so a single instance of each is reused for the lifetime of the process.
+_STORAGE_CLIENT = None
+_BUILD_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+def _get_storage_client() -> storage.Client:
+    """Returns the process-wide Cloud Storage client, creating it on first use."""
+    global _STORAGE_CLIENT
+    if _STORAGE_CLIENT is None:
+        with _CLIENT_LOCK:
+            if _STORAGE_CLIENT is None:
+                _STORAGE_CLIENT = storage.Client(project=GCP_PROJECT_ID)
+    return _STORAGE_CLIENT
+
+def _get_build_client() -> cloudbuild_v1.CloudBuildClient:
+    """Returns the process-wide Cloud Build client, creating it on first use."""
+    global _BUILD_CLIENT
+    if _BUILD_CLIENT is None:
+        with _CLIENT_LOCK:
+            if _BUILD_CLIENT is None:
+                _BUILD_CLIENT = cloudbuild_v1.CloudBuildClient()
+    return _BUILD_CLIENT
+
+# google.generativeai is only needed when there is something to summarize,
+# so it is imported on first use rather than at module load.
+_GENAI = None
+_GENAI_UNAVAILABLE = False
+
+def _get_genai():
+    """Returns the configured google.generativeai module, or None if it cannot be imported."""
+    global _GENAI, _GENAI_UNAVAILABLE
+    if _GENAI is None and not _GENAI_UNAVAILABLE:
+        try:
+            import google.generativeai as genai
+        except ImportError as e:
+            # Remember the failure so the warning is logged once, not on every summary request.
+            _GENAI_UNAVAILABLE = True
+            logger.warning("BTA: google.generativeai is not available: %s", e)
             return None
-        logging.info(f"BTA: Downloading artifact gs://{bucket_name}/{object_name}")
-        return blob.download_as_text()
+        # configure() swaps out the module's global client, so it is done once here
+        # rather than before every summary.
+        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+        _GENAI = genai
+    return _GENAI
+
+_GEMINI_MODEL = None
+
+def _get_gemini_model():
+    """Returns the shared GenerativeModel for GEMINI_MODEL_NAME, creating it on first use."""
+    global _GEMINI_MODEL
+    if _GEMINI_MODEL is None:
+        genai = _get_genai()
+        if genai is None:
+            return None
+        with _CLIENT_LOCK:
+            if _GEMINI_MODEL is None:
+                # Temperature 0 keeps summaries deterministic, so a cached response is the
+                # same answer a fresh call would give; the output cap bounds response time.
+                _GEMINI_MODEL = genai.GenerativeModel(GEMINI_MODEL_NAME, generation_config={"temperature": 0.0, "max_output_tokens": MAX_SUMMARY_OUTPUT_TOKENS})
+    return _GEMINI_MODEL
+
+# Re-runs of the same commit produce identical prompts, so Gemini responses are kept
+# in a small LRU keyed by a hash of the model and prompt (the prompt itself is not retained).
+_SUMMARY_CACHE: OrderedDict[str, str] = OrderedDict()
+_SUMMARY_CACHE_LOCK = threading.Lock()
+
+def _generate_summary(model, prompt: str) -> str:
+    """Returns the model's response text for prompt, reusing the result for a previously seen prompt."""
+    prompt_hash = hashlib.sha256(f"{GEMINI_MODEL_NAME}|{prompt}".encode("utf-8")).hexdigest()
+    with _SUMMARY_CACHE_LOCK:
+        cached = _SUMMARY_CACHE.get(prompt_hash)
+        if cached is not None:
+            _SUMMARY_CACHE.move_to_end(prompt_hash)
+            logger.info("BTA: Reusing cached Gemini summary.")
+            return cached
+
+    # Only successful responses reach the cache; errors propagate to the caller.
+    summary = model.generate_content(prompt).text
+    with _SUMMARY_CACHE_LOCK:
+        _SUMMARY_CACHE[prompt_hash] = summary
+        if len(_SUMMARY_CACHE) > SUMMARY_CACHE_SIZE:
+            _SUMMARY_CACHE.popitem(last=False)
+    return summary
+
+def _open_gcs_artifact(bucket_name: str, object_name: str):
+    """Opens a GCS artifact for line-by-line text reads without downloading it up front."""
+    storage_client = _get_storage_client()
+    blob = storage_client.bucket(bucket_name).blob(object_name)
+    logger.info("BTA: Streaming artifact gs://%s/%s", bucket_name, object_name)
+    # Read in fixed-size ranged chunks; the library default (40 MiB) would buffer most
+    # test-result files in one request and defeat the point of streaming them.
+    return blob.open("r", encoding="utf-8", chunk_size=ARTIFACT_READ_CHUNK_SIZE)
+
+def _load_go_test_results(bucket_name: str, object_name: str) -> dict | None:
+    """Streams a 'go test -json' artifact from GCS into the parser. Returns None if it cannot be read."""
+    try:
+        # The object is fetched in chunks as the parser consumes lines; a missing
+        # object surfaces as NotFound on the first read rather than via an exists() probe.
+        with _open_gcs_artifact(bucket_name, object_name) as f:
+            return _parse_go_test_json(f)
+    except api_exceptions.NotFound:
+        logger.warning("BTA: Artifact not found in GCS: gs://%s/%s", bucket_name, object_name)
+        return None
     except Exception as e:
-        logging.error(f"BTA: Failed to download GCS artifact gs://{bucket_name}/{object_name}: {e}")
+        logger.error(f"BTA: Failed to read GCS artifact gs://{bucket_name}/{object_name}: {e}")
         return None
 
-def _parse_go_test_json(json_content: str) -> dict:
-    """Parses the line-by-line JSON output from 'go test -json'."""
+def _parse_go_test_json(lines: Iterable[str]) -> dict:
+    """Parses the line-by-line JSON output from 'go test -json', given any iterable of lines."""
     results = {"tests": 0, "failures": 0, "skipped": 0, "failure_details": []}
-    if not json_content:
-        return results
+    if isinstance(lines, str):
+        lines = io.StringIO(lines)
 
     test_outputs = {}
-    test_events = []
+    failed_tests = {} # Insertion-ordered set of failed test names
+    skipped_lines = 0
     
-    # First pass: decode all lines into a list of event dictionaries
-    for line in json_content.strip().split('\n'):
+    # Single pass: decode each line and update counters, output buffers and failures as we go
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
         try:
             event = json.loads(line)
-            test_events.append(event)
         except json.JSONDecodeError:
-            logging.warning(f"BTA: Skipping non-JSON line in test output: {line}")
+            # Counted and reported once below; malformed output can run to thousands of lines.
+            skipped_lines += 1
             continue
 
-    # Second pass: process the events to count tests and collect outputs
-    for event in test_events:
-        action = event.get("Action")
         test_name = event.get("Test")
-
         # Only process events associated with a specific test
         if not test_name:
             continue
 
-        if action == "run":
+        action = event.get("Action")
+        if action == "output":
+            output = test_outputs.get(test_name)
+            if output is not None:
+                output.append(event.get("Output", ""))
+        elif action == "run":
             results["tests"] += 1
             test_outputs[test_name] = [] # Initialize output buffer for this test
-
-        elif action == "output" and test_name in test_outputs:
-            test_outputs[test_name].append(event.get("Output", ""))
-        
+        elif action == "pass":
+            # Output is only reported for failures, so release it as soon as a test passes
+            test_outputs.pop(test_name, None)
+        elif action == "fail":
+            failed_tests[test_name] = None
         elif action == "skip":
             results["skipped"] += 1
+            test_outputs.pop(test_name, None)
+    if skipped_lines:
+        logger.warning("BTA: Skipped %d non-JSON lines in test output.", skipped_lines)
 
-    # Third pass: Now that all outputs are collected, create failure details for any failed tests
-    failed_tests = {event.get("Test") for event in test_events if event.get("Action") == "fail" and event.get("Test")}
-    
     for test_name in failed_tests:
-        failure_detail = {
+        outputs = test_outputs.get(test_name)
+        results["failure_details"].append({
             "test_name": test_name,
-            "details": "".join(test_outputs.get(test_name, ["No output captured for this test."])).strip()
-        }
-        results["failure_details"].append(failure_detail)
+            "details": "".join(outputs).strip() if outputs else "No output captured for this test."
+        })
 
     results['failures'] = len(results['failure_details'])
-    logging.info(f"BTA: Parsed test results: Total={results['tests']}, Failures={results['failures']}")
+    logger.info("BTA: Parsed test results: Total=%d, Failures=%d", results['tests'], results['failures'])
     return results
 
 def _summarize_test_failures_with_gemini(failure_details: list) -> str:
     if not failure_details:
         return "No failures to summarize."
-    if not GCP_PROJECT_ID or not VERTEX_AI_LOCATION or 'genai' not in globals() or not hasattr(genai,'GenerativeModel'):
-        logging.warning("BTA: Gemini client not configured, cannot summarize failures.")
+    if not GCP_PROJECT_ID or not VERTEX_AI_LOCATION or _get_genai() is None:
+        logger.warning("BTA: Gemini client not configured, cannot summarize failures.")
         return "Gemini summarization not available. Raw failure details provided."
     try:
-        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
-        prompt = "You are a helpful assistant. Summarize the following test failures from a CI build. Be concise and highlight the main reasons for failures if possible:\n\n"
-        for i, f in enumerate(failure_details):
-            prompt += f"Failure {i+1}:\n"
-            prompt += f"  Test: {f.get('class_name', '')}.{f.get('test_name', '')}\n"
-            prompt += f"  Message: {f.get('message', '')}\n"
-            prompt += f"  Details: {f.get('details', '')[:500]}\n\n" 
-        logging.info("BTA: Sending test failures to Gemini for summarization...")
-        response = model.generate_content(prompt)
-        summary = response.text
-        logging.info("BTA: Gemini summarization successful.")
+        model = _get_gemini_model()
+        parts = ["You are a helpful assistant. Summarize the following test failures from a CI build. Be concise and highlight the main reasons for failures if possible:\n\n"]
+        # Table-driven tests often fail the same way many times over; send each distinct
+        # message/details pair once with its occurrence count.
+        # The framing lines and the test's own name differ between otherwise identical
+        # failures, so they are left out of the grouping key.
+        groups = {}
+        for f in failure_details:
+            details = _GO_TEST_FRAMING_RE.sub("", f.get('details', '')).strip()
+            test_name = f.get('test_name', '')
+            key = (f.get('message', '')[:200], (details.replace(test_name, "<test>") if test_name else details)[:500])
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [f, 1, details[:500]]
+            else:
+                group[1] += 1
+        # Prompt size drives Gemini latency, so only the first failures that fit the budget are sent.
+        prompt_size = len(parts[0])
+        included = 0
+        for i, ((message, _), (f, count, details)) in enumerate(list(groups.items())[:MAX_SUMMARIZED_FAILURES]):
+            occurrences = f" (x{count} occurrences)" if count > 1 else ""
+            entry = (
+                f"Failure {i+1}{occurrences}:\n"
+                f"  Test: {f.get('class_name', '')}.{f.get('test_name', '')[:120]}\n"
+                f"  Message: {message}\n"
+                f"  Details: {details}\n\n"
+            )
+            if included and prompt_size + len(entry) > MAX_FAILURE_PROMPT_CHARS:
+                break
+            parts.append(entry)
+            prompt_size += len(entry)
+            included += count
+        omitted = len(failure_details) - included
+        if omitted:
+            parts.append(f"...and {omitted} more failures not shown.\n")
+        prompt = "".join(parts)
+        logger.info("BTA: Sending test failures to Gemini for summarization...")
+        summary = _generate_summary(model, prompt)
+        logger.info("BTA: Gemini summarization successful.")
         return summary
     except Exception as e:
-        logging.error(f"BTA: Error during Gemini summarization: {e}")
+        logger.error(f"BTA: Error during Gemini summarization: {e}")
         return f"Could not summarize failures due to an error: {e}. Raw details: {str(failure_details)}"
 
 
@@ -131,9 +282,9 @@ def trigger_build_and_monitor(
     if not all([trigger_id, project_id, repo_name, branch_name, commit_sha]):
         return {"status": "ERROR", "error_message": "Missing required parameters for build trigger."}
     
-    logging.info(f"BTA Agent: Triggering build for repo '{repo_name}' on branch '{branch_name}' with commit '{commit_sha}'.")
+    logger.info("BTA Agent: Triggering build for repo '%s' on branch '%s' with commit '%s'.", repo_name, branch_name, commit_sha)
     
-    client = cloudbuild_v1.CloudBuildClient()
+    client = _get_build_client()
     
     # Configure the build request
     repo_source = cloudbuild_v1.RepoSource()
@@ -153,64 +304,72 @@ def trigger_build_and_monitor(
         
         build_id = operation.metadata.build.id
         print(f"📋 Build started with ID: {build_id}")
+
+        # The trigger tags the image with the commit SHA, so the URI is known up front
+        # and does not depend on anything in the finished build.
+        image_uri_commit = IMAGE_URI_TEMPLATE.format(project_id=project_id, tag=commit_sha)
         
-        # Monitor the build
+        # Monitor the build, backing off between polls so short builds are noticed quickly
+        # and long ones are not polled needlessly often. Polls request only the status
+        # field; the full Build (steps, results, log URL) is fetched once it has finished.
         print("⏳ Monitoring build progress...")
+        poll_interval = BUILD_POLL_INITIAL_SECONDS
+        while True:
+            status = client.get_build(project_id=project_id, id=build_id, metadata=_STATUS_ONLY_METADATA).status
+            if status not in (cloudbuild_v1.Build.Status.QUEUED, cloudbuild_v1.Build.Status.WORKING):
+                break
+            print(f"🔄 Build status: {status.name}")
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 1.5, BUILD_POLL_MAX_SECONDS)
         build = client.get_build(project_id=project_id, id=build_id)
         
-        while build.status in [cloudbuild_v1.Build.Status.QUEUED, cloudbuild_v1.Build.Status.WORKING]:
-            time.sleep(10)
-            build = client.get_build(project_id=project_id, id=build_id)
-            print(f"🔄 Build status: {build.status.name}")
-        
         # Build completed - capture detailed results
         final_status = build.status.name
         print(f"📊 Build completed with status: {final_status}")
-        
-        # Extract build logs if available
+
+        # Extract build logs if available. Green builds skip this: a Gemini summary of a
+        # passing build only restates its steps, and test failures are summarized separately.
         build_logs = ""
         log_summary = ""
-        if hasattr(build, 'log_url') and build.log_url:
+        if build.status != cloudbuild_v1.Build.Status.SUCCESS and build.log_url:
             try:
                 # Try to fetch and summarize logs
                 build_logs = fetch_build_logs(build.log_url)
                 if build_logs:
                     log_summary = summarize_build_logs_with_gemini(build_logs, final_status)
             except Exception as e:
-                logging.warning(f"Could not fetch build logs: {e}")
+                logger.warning("Could not fetch build logs: %s", e)
                 log_summary = f"Build logs available at: {build.log_url}"
         
         # Prepare response based on build status
         if build.status == cloudbuild_v1.Build.Status.SUCCESS:
             # Extract image information
             image_info = {}
-            if build.results and build.results.images:
-                first_image = build.results.images[0]
+            images = build.results.images
+            if images:
+                first_image = images[0]
                 image_info = {
                     "name": first_image.name,
                     "digest": first_image.digest
                 }
             
-            # Extract test results if available
             test_results = extract_test_results(build, commit_sha)
             
             success_message = f"Build completed successfully for {repo_name}:{branch_name}"
-            if log_summary:
-                success_message += f"\n\n📋 Build Summary:\n{log_summary}"
             
             return {
                 "status": "SUCCESS",
                 "message": success_message,
                 "build_id": build_id,
-                "image_uri_commit": f"{image_info.get('name', '')}",
+                "image_uri_commit": image_uri_commit,
                 "details": {
                     "results": {
                         "images": [image_info] if image_info else []
                     }
                 },
                 "test_results": test_results,
-                "build_logs": build_logs[:1000] if build_logs else "",  # First 1000 chars
-                "log_summary": log_summary
+                "build_logs": "",
+                "log_summary": ""
             }
         else:
             # Build failed
@@ -224,18 +383,58 @@ def trigger_build_and_monitor(
                 "status": "FAILURE",
                 "error_message": failure_message,
                 "build_id": build_id,
+                "test_results": _test_results_for_failed_build(build),
                 "build_logs": build_logs[:1000] if build_logs else "",
                 "log_summary": log_summary
             }
             
     except Exception as e:
         error_msg = f"BTA Agent: Error during build trigger or monitoring: {e}"
-        logging.exception(error_msg)
+        logger.exception(error_msg)
         return {"status": "ERROR", "error_message": error_msg}
 
-def fetch_build_logs(log_url: str) -> str:
+def _test_results_for_failed_build(build) -> dict:
+    """
+    Reports test status for a failed build from its step list alone.
+
+    Steps after the failing one never run, so the results upload is never reached and
+    there is no artifact in GCS to fetch. When no step failed before the test step (e.g. a
+    cancelled build, or an internal error), the step list cannot say whether tests ran.
     """
-    Fetch build logs from Cloud Storage URL.
+    steps = list(build.steps)
+    failed_index, failed_step = next(
+        ((index, step) for index, step in enumerate(steps)
+         if step.status in (cloudbuild_v1.Build.Status.FAILURE, cloudbuild_v1.Build.Status.TIMEOUT)),
+        (None, None)
+    )
+    test_index = next((index for index, step in enumerate(steps) if step.id == TEST_STEP_ID), None)
+
+    if failed_step is not None and failed_index == test_index:
+        return {
+            "test_status": "FAILED",
+            "failure_summary": f"Test step '{TEST_STEP_ID}' failed; see build logs for details."
+        }
+    if failed_step is not None and test_index is not None and failed_index < test_index:
+        return {
+            "test_status": "NOT_RUN",
+            "failure_summary": f"Tests did not run because the build failed before the test stage (failed at step '{failed_step.id or failed_step.name}')."
+        }
+    return {
+        "test_status": "UNKNOWN",
+        "failure_summary": f"Build ended with status {build.status.name}; test results could not be determined from the build steps."
+    }
+
+def _head_and_tail(text: str, limit: int) -> str:
+    """Shortens text to about limit characters, keeping its start and end where errors usually appear."""
+    if len(text) <= limit:
+        return text
+    half = limit // 2
+    return f"{text[:half]}\n...\n{text[-half:]}"
+
+def fetch_build_logs(log_url: str, max_bytes: int = MAX_BUILD_LOG_BYTES) -> str:
+    """
+    Fetch up to max_bytes of build logs from a Cloud Storage URL.
+    Longer logs are returned as their first and last max_bytes/2, since a failing step's error is at the end.
     """
     try:
         # Extract bucket and object from log URL
@@ -249,17 +448,28 @@ def fetch_build_logs(log_url: str) -> str:
         
         bucket_name, object_name = path_parts
         
-        # Download the log file
-        storage_client = storage.Client()
+        # Look up the log object; its size decides which byte ranges to download
+        storage_client = _get_storage_client()
         bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(object_name)
+        blob = bucket.get_blob(object_name)
+        if blob is None:
+            return ""
         
-        # Download as text
-        log_content = blob.download_as_text()
-        return log_content
+        # Ranged downloads: only the head and tail that are summarized cross the network
+        if blob.size is None or blob.size <= max_bytes:
+            log_content = blob.download_as_bytes(start=0, end=max_bytes - 1)
+        else:
+            half = max_bytes // 2
+            head = blob.download_as_bytes(start=0, end=half - 1)
+            tail = blob.download_as_bytes(start=blob.size - half, end=blob.size - 1)
+            log_content = head + b"\n...\n" + tail
+        # Colour codes carry no information for a summary but do cost prompt tokens
+        log_content = _ANSI_ESCAPE_RE.sub(b"", log_content)
+        # The ranges may start or end mid-character, so decode leniently
+        return log_content.decode("utf-8", errors="replace")
         
     except Exception as e:
-        logging.warning(f"Could not fetch build logs from {log_url}: {e}")
+        logger.warning("Could not fetch build logs from %s: %s", log_url, e)
         return ""
 
 def summarize_build_logs_with_gemini(logs: str, build_status: str) -> str:
@@ -267,11 +477,9 @@ def summarize_build_logs_with_gemini(logs: str, build_status: str) -> str:
     Use Gemini to summarize build logs and provide insights.
     """
     try:
-        import google.generativeai as genai
-        
-        # Configure Gemini
-        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-        model = genai.GenerativeModel('gemini-2.0-flash')
+        model = _get_gemini_model()
+        if model is None:
+            raise ImportError("google.generativeai is not installed")
         
         prompt = f"""
         Analyze the following Cloud Build logs and provide a concise summary:
@@ -279,7 +487,7 @@ def summarize_build_logs_with_gemini(logs: str, build_status: str) -> str:
         Build Status: {build_status}
         
         Build Logs:
-        {logs[:4000]}  # Limit to first 4000 characters
+        {_head_and_tail(logs, MAX_PROMPT_LOG_CHARS)}
         
         Please provide:
         1. A brief summary of what the build did
@@ -290,11 +498,10 @@ def summarize_build_logs_with_gemini(logs: str, build_status: str) -> str:
         Keep the response concise and actionable.
         """
         
-        response = model.generate_content(prompt)
-        return response.text
+        return _generate_summary(model, prompt)
         
     except Exception as e:
-        logging.warning(f"Could not summarize logs with Gemini: {e}")
+        logger.warning("Could not summarize logs with Gemini: %s", e)
         return f"Build completed with status: {build_status}. Manual log review may be needed."
 
 def extract_test_results(build, commit_sha: str = None) -> dict:
@@ -309,7 +516,7 @@ def extract_test_results(build, commit_sha: str = None) -> dict:
         commit_sha: The commit SHA (passed from trigger_build_and_monitor)
     """
     build_id = build.id
-    logging.info(f"BTA: Extracting test results for build {build_id}")
+    logger.info("BTA: Extracting test results for build %s", build_id)
     
     # Default response if no test results found
     default_result = {
@@ -320,71 +527,64 @@ def extract_test_results(build, commit_sha: str = None) -> dict:
     try:
         # If commit_sha is provided, use it directly (much simpler!)
         if commit_sha:
-            logging.info(f"BTA: Using provided commit SHA: {commit_sha}")
-            test_results_path = f"test-results/{commit_sha}/test_results.json"
+            logger.info("BTA: Using provided commit SHA: %s", commit_sha)
+            # Primary location first, then the alternatives. dict.fromkeys drops repeats,
+            # e.g. the short-SHA path when the caller already passed a short SHA.
+            candidate_paths = dict.fromkeys([
+                f"test-results/{commit_sha}/test_results.json",
+                f"test-results/{commit_sha[:8]}/test_results.json",  # Short SHA
+                f"builds/{build_id}/test-results.json",             # Build ID path
+                f"test-results/{build_id}/test_results.json",       # Alternative build ID path
+            ])
             
-            # Try to download the test results from GCS
-            test_json = _download_gcs_artifact(TEST_RESULTS_BUCKET_NAME, test_results_path)
+            results = None
+            for test_results_path in candidate_paths:
+                results = _load_go_test_results(TEST_RESULTS_BUCKET_NAME, test_results_path)
+                if results is not None:
+                    logger.info("BTA: Found test results at gs://%s/%s", TEST_RESULTS_BUCKET_NAME, test_results_path)
+                    break
             
-            if not test_json:
-                logging.info(f"BTA: No test results found at gs://{TEST_RESULTS_BUCKET_NAME}/{test_results_path}")
-                # Try alternative paths with the provided commit_sha
-                alternative_paths = [
-                    f"test-results/{commit_sha[:8]}/test_results.json",  # Short SHA
-                    f"builds/{build_id}/test-results.json",             # Build ID path
-                    f"test-results/{build_id}/test_results.json",       # Alternative build ID path
-                ]
-                
-                for alt_path in alternative_paths:
-                    test_json = _download_gcs_artifact(TEST_RESULTS_BUCKET_NAME, alt_path)
-                    if test_json:
-                        logging.info(f"BTA: Found test results at alternative path: gs://{TEST_RESULTS_BUCKET_NAME}/{alt_path}")
-                        break
-                
-                if not test_json:
-                    return default_result
+            if results is None:
+                return default_result
         else:
             # Fallback: try to get commit_sha from build object (keep this as backup)
-            logging.warning(f"BTA: No commit SHA provided, trying to extract from build object")
-            
-            # Try multiple ways to get the commit SHA from build object
-            extracted_commit_sha = None
-            if hasattr(build, 'source') and build.source and hasattr(build.source, 'repo_source') and build.source.repo_source:
-                extracted_commit_sha = build.source.repo_source.commit_sha
-                logging.info(f"BTA: Found commit SHA from source.repo_source: {extracted_commit_sha}")
+            logger.warning("BTA: No commit SHA provided, trying to extract from build object")
             
-            if not extracted_commit_sha and hasattr(build, 'substitutions') and build.substitutions:
-                extracted_commit_sha = (build.substitutions.get('COMMIT_SHA') or 
-                                      build.substitutions.get('_COMMIT_SHA') or 
-                                      build.substitutions.get('SHORT_SHA') or
-                                      build.substitutions.get('_SHORT_SHA'))
+            # Try the repo source first, then the substitutions the trigger sets.
+            # Unset proto message/map fields read as empty, so no hasattr checks are needed.
+            extracted_commit_sha = build.source.repo_source.commit_sha
+            if extracted_commit_sha:
+                logger.info("BTA: Found commit SHA from source.repo_source: %s", extracted_commit_sha)
+            else:
+                substitutions = build.substitutions
+                extracted_commit_sha = (substitutions.get('COMMIT_SHA') or
+                                        substitutions.get('_COMMIT_SHA') or
+                                        substitutions.get('SHORT_SHA') or
+                                        substitutions.get('_SHORT_SHA'))
                 if extracted_commit_sha:
-                    logging.info(f"BTA: Found commit SHA from substitutions: {extracted_commit_sha}")
+                    logger.info("BTA: Found commit SHA from substitutions: %s", extracted_commit_sha)
             
             if extracted_commit_sha:
                 test_results_path = f"test-results/{extracted_commit_sha}/test_results.json"
-                test_json = _download_gcs_artifact(TEST_RESULTS_BUCKET_NAME, test_results_path)
+                results = _load_go_test_results(TEST_RESULTS_BUCKET_NAME, test_results_path)
             else:
                 # Last resort: try build_id paths
-                logging.warning(f"BTA: Could not determine commit SHA, trying build_id as fallback")
+                logger.warning("BTA: Could not determine commit SHA, trying build_id as fallback")
                 possible_paths = [
                     f"test-results/{build_id}/test_results.json",
                     f"builds/{build_id}/test-results.json",
                 ]
                 
-                test_json = None
+                results = None
                 for test_results_path in possible_paths:
-                    test_json = _download_gcs_artifact(TEST_RESULTS_BUCKET_NAME, test_results_path)
-                    if test_json:
-                        logging.info(f"BTA: Found test results at gs://{TEST_RESULTS_BUCKET_NAME}/{test_results_path}")
+                    results = _load_go_test_results(TEST_RESULTS_BUCKET_NAME, test_results_path)
+                    if results is not None:
+                        logger.info("BTA: Found test results at gs://%s/%s", TEST_RESULTS_BUCKET_NAME, test_results_path)
                         break
             
-            if not test_json:
+            if results is None:
                 return default_result
         
-        # Parse the test results
-        results = _parse_go_test_json(test_json)
-        
         # Get a summary of failures if there are any
         failure_summary = ""
         if results.get("failures", 0) > 0 and results.get("failure_details"):
@@ -402,11 +602,11 @@ def extract_test_results(build, commit_sha: str = None) -> dict:
             "failure_summary": failure_summary
         }
         
-        logging.info(f"BTA: Extracted test results: {test_result['tests_total']} tests, {test_result['tests_failed']} failures")
+        logger.info("BTA: Extracted test results: %d tests, %d failures", test_result['tests_total'], test_result['tests_failed'])
         return test_result
         
     except Exception as e:
-        logging.error(f"BTA: Error extracting test results: {e}")
+        logger.error(f"BTA: Error extracting test results: {e}")
         return {
             "test_status": "ERROR",
             "message": f"Error extracting test results: {str(e)}"
@@ -422,6 +622,7 @@ bta_agent = Agent(
 
 # --- Local Testing Example for BTA ---
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     if not GCP_PROJECT_ID or not os.getenv("TARGET_APP_TRIGGER_ID") or not os.getenv("TEST_RESULTS_BUCKET_NAME") or not os.getenv("GOOGLE_CLOUD_LOCATION"):
         print("Error: Ensure GOOGLE_CLOUD_PROJECT, TARGET_APP_TRIGGER_ID, TEST_RESULTS_BUCKET_NAME, and GOOGLE_CLOUD_LOCATION env vars are set.")
     else:
@@ -3,23 +3,148 @@
 # Compatible with google-cloud-run v0.10.x for IAM calls
 
 import os
+import asyncio
 import logging
 import time
+import threading
+import concurrent.futures
 from google.adk.agents import Agent
 from google.cloud import run_v2 
 from google.api_core import exceptions as api_exceptions 
+from google.api_core.client_options import ClientOptions
 from google.iam.v1 import iam_policy_pb2
 from google.iam.v1 import policy_pb2
 from dotenv import load_dotenv 
 load_dotenv() 
 
-# Configure basic logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # --- Configuration ---
 GCP_PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
 DEFAULT_CLOUD_RUN_REGION = os.getenv("CLOUD_RUN_REGION", "us-central1")
 DEFAULT_SERVICE_NAME = "geminiflow-hello-world-svc"
+DEPLOY_TIMEOUT_SECONDS = int(os.getenv("DA_DEPLOY_TIMEOUT_SECONDS", "600")) # Deadline for a revision rollout
+MAX_CONCURRENT_DEPLOYS = int(os.getenv("DA_MAX_CONCURRENCY", "8")) # Keeps batch deploys under the Cloud Run admin write quota
+
+# Invariant pieces of the deploy request, built once. Only the Container (which carries the
+# image) is constructed per call; proto-plus copies these into the parent message on assignment.
+_CONTAINER_PORT = run_v2.types.ContainerPort(container_port=8080)
+_INGRESS_ALL = run_v2.types.IngressTraffic.INGRESS_TRAFFIC_ALL
+_TRAFFIC_TO_LATEST = run_v2.types.TrafficTargetAllocationType.TRAFFIC_TARGET_ALLOCATION_TYPE_LATEST
+
+# Response field masks for reads, so Cloud Run only serializes the fields each caller uses
+# instead of the full Service/Revision (conditions, annotations, labels, traffic history...).
+_UNCHANGED_CHECK_METADATA = ((
+    "x-goog-fieldmask",
+    "name,uri,ingress,template.containers.image,latest_ready_revision,latest_created_revision,traffic_statuses.type",
+),)
+_SERVICE_DETAILS_METADATA = (("x-goog-fieldmask", "name,uri"),)
+_LATEST_REVISION_METADATA = (("x-goog-fieldmask", "latest_ready_revision"),)
+_REVISION_IMAGE_METADATA = (("x-goog-fieldmask", "containers.image"),)
+
+# --- Shared Clients ---
+# Constructing a client re-runs credential discovery and opens a new gRPC channel,
+# so one instance of each is reused per region for the lifetime of the process.
+# Each is pointed at the regional endpoint so RPCs terminate in the deploy region
+# rather than going through the global run.googleapis.com front end.
+_SERVICES_CLIENTS: dict[str, run_v2.ServicesClient] = {}
+_REVISIONS_CLIENTS: dict[str, run_v2.RevisionsClient] = {}
+_CLIENT_LOCK = threading.Lock()
+
+def _regional_client_options(region: str) -> ClientOptions:
+    """Returns client options targeting the Cloud Run endpoint for region."""
+    return ClientOptions(api_endpoint=f"{region}-run.googleapis.com")
+
+def _get_services_client(region: str) -> run_v2.ServicesClient:
+    """Returns the process-wide Cloud Run Services client for region, creating it on first use."""
+    client = _SERVICES_CLIENTS.get(region)
+    if client is None:
+        with _CLIENT_LOCK:
+            client = _SERVICES_CLIENTS.get(region)
+            if client is None:
+                client = run_v2.ServicesClient(client_options=_regional_client_options(region))
+                _SERVICES_CLIENTS[region] = client
+    return client
+
+def _get_revisions_client(region: str) -> run_v2.RevisionsClient:
+    """Returns the process-wide Cloud Run Revisions client for region, creating it on first use."""
+    client = _REVISIONS_CLIENTS.get(region)
+    if client is None:
+        with _CLIENT_LOCK:
+            client = _REVISIONS_CLIENTS.get(region)
+            if client is None:
+                client = run_v2.RevisionsClient(client_options=_regional_client_options(region))
+                _REVISIONS_CLIENTS[region] = client
+    return client
+
+
+# --- IAM Check Cache ---
+# Redeploys of the same service keep its IAM policy, so once a service is known to grant
+# roles/run.invoker to allUsers the policy read (and write) is skipped for a while.
+IAM_CACHE_TTL_SECONDS = int(os.getenv("DA_IAM_CACHE_TTL_SECONDS", "300"))
+_PUBLIC_SERVICE_CACHE: dict[str, float] = {}
+_PUBLIC_SERVICE_CACHE_LOCK = threading.Lock()
+
+def _is_known_public(service_full_name: str) -> bool:
+    """Returns True if the service was confirmed publicly invokable within IAM_CACHE_TTL_SECONDS."""
+    with _PUBLIC_SERVICE_CACHE_LOCK:
+        confirmed_at = _PUBLIC_SERVICE_CACHE.get(service_full_name)
+    return confirmed_at is not None and time.monotonic() - confirmed_at < IAM_CACHE_TTL_SECONDS
+
+def _mark_public(service_full_name: str) -> None:
+    """Records that the service's IAM policy grants public invocation."""
+    with _PUBLIC_SERVICE_CACHE_LOCK:
+        _PUBLIC_SERVICE_CACHE[service_full_name] = time.monotonic()
+
+def warm_clients(region: str = DEFAULT_CLOUD_RUN_REGION) -> None:
+    """Creates the shared Cloud Run clients for region ahead of the first deploy (e.g. at server startup)."""
+    _get_services_client(region)
+    _get_revisions_client(region)
+
+
+# --- No-op Redeploy Detection ---
+# CI re-runs on an unchanged commit ask for the image that is already serving. The last
+# image this process deployed per service is remembered, and only when a request repeats it
+# is the live service fetched to confirm nothing has changed since (e.g. a rollback moving
+# traffic); fresh images go straight to update_service without the extra read.
+_DEPLOYED_IMAGES: dict[str, str] = {}
+_DEPLOYED_IMAGES_LOCK = threading.Lock()
+
+def _is_pinned_image(image_uri: str) -> bool:
+    """Returns True unless the image reference is untagged or ':latest', which can move between deploys."""
+    if "@" in image_uri:
+        return True
+    last_segment = image_uri.rsplit("/", 1)[-1]
+    return ":" in last_segment and not last_segment.endswith(":latest")
+
+def _get_unchanged_service(client: run_v2.ServicesClient, service_full_path: str, image_uri: str):
+    """
+    Returns the live Service if it already runs image_uri with public ingress, a healthy latest
+    revision and all traffic on that revision; otherwise None so the caller rolls out as usual.
+    """
+    with _DEPLOYED_IMAGES_LOCK:
+        last_image = _DEPLOYED_IMAGES.get(service_full_path)
+    if last_image != image_uri or not _is_pinned_image(image_uri):
+        return None
+    try:
+        existing = client.get_service(name=service_full_path, metadata=_UNCHANGED_CHECK_METADATA)
+    except api_exceptions.NotFound:
+        return None
+    containers = existing.template.containers
+    if not containers or containers[0].image != image_uri:
+        return None
+    if existing.ingress != _INGRESS_ALL:
+        return None
+    if not existing.latest_ready_revision or existing.latest_ready_revision != existing.latest_created_revision:
+        return None
+    if not existing.traffic_statuses or any(t.type_ != _TRAFFIC_TO_LATEST for t in existing.traffic_statuses):
+        return None
+    return existing
+
+def _remember_deployed_image(service_full_path: str, image_uri: str) -> None:
+    """Records the image most recently rolled out to the service by this process."""
+    with _DEPLOYED_IMAGES_LOCK:
+        _DEPLOYED_IMAGES[service_full_path] = image_uri
 
 
 # --- DA Tools ---
@@ -35,17 +160,20 @@ def deploy_to_cloud_run(
     It will create the service if it doesn't exist, or update it if it does.
     Compatible with older google-cloud-run client library versions for IAM calls.
     """
-    if not all([project_id, region, service_name, image_uri]):
-        missing_params = [
-            p for p, v in locals().items()
-            if p in ["project_id", "region", "service_name", "image_uri"] and not v
-        ]
+    missing_params = [
+        name for name, value in (
+            ("project_id", project_id), ("region", region),
+            ("service_name", service_name), ("image_uri", image_uri),
+        )
+        if not value
+    ]
+    if missing_params:
         return {"status": "ERROR", "error_message": f"Missing required parameters: {', '.join(missing_params)}"}
 
-    logging.info(f"Attempting to deploy to Cloud Run: project='{project_id}', region='{region}', service='{service_name}', image='{image_uri}'")
+    logger.info(f"Attempting to deploy to Cloud Run: project='{project_id}', region='{region}', service='{service_name}', image='{image_uri}'")
 
     try:
-        client = run_v2.ServicesClient()
+        client = _get_services_client(region)
         parent = f"projects/{project_id}/locations/{region}"
         service_full_path = f"{parent}/services/{service_name}"
 
@@ -53,50 +181,59 @@ def deploy_to_cloud_run(
             containers=[
                 run_v2.types.Container(
                     image=image_uri,
-                    ports=[run_v2.types.ContainerPort(container_port=8080)],
+                    ports=[_CONTAINER_PORT],
                 )
             ],
         )
-        service_ingress_config = run_v2.types.IngressTraffic.INGRESS_TRAFFIC_ALL
+        service_ingress_config = _INGRESS_ALL
 
-        try:
-            logging.info(f"Checking if service '{service_name}' already exists at '{service_full_path}'...")
-            client.get_service(name=service_full_path)
-            
-            logging.info(f"Service '{service_name}' exists. Updating service...")
-            service_config_for_update = run_v2.types.Service(
-                name=service_full_path,
-                template=service_template_config,
-                ingress=service_ingress_config
-            )
-            operation = client.update_service(service=service_config_for_update)
-            action_taken = "updated"
-
-        except api_exceptions.NotFound:
-            logging.info(f"Service '{service_name}' does not exist. Creating service...")
-            service_config_for_create = run_v2.types.Service(
-                template=service_template_config,
-                ingress=service_ingress_config
-            )
-            operation = client.create_service(
-                parent=parent,
-                service=service_config_for_create,
-                service_id=service_name
-            )
-            action_taken = "created"
+        deployed_service = _get_unchanged_service(client, service_full_path, image_uri)
+        if deployed_service is not None:
+            action_taken = "unchanged"
+            service_url = deployed_service.uri
+            logger.info(f"Service '{service_name}' already serves image '{image_uri}'; skipping rollout. URL: {service_url}")
+        else:
+            try:
+                # Update in place first; a missing service surfaces as NotFound on the request itself,
+                # so no separate get_service probe is needed to choose between update and create.
+                logger.info(f"Updating service '{service_name}' at '{service_full_path}'...")
+                service_config_for_update = run_v2.types.Service(
+                    name=service_full_path,
+                    template=service_template_config,
+                    ingress=service_ingress_config
+                )
+                operation = client.update_service(service=service_config_for_update)
+                action_taken = "updated"
+
+            except api_exceptions.NotFound:
+                logger.info(f"Service '{service_name}' does not exist. Creating service...")
+                service_config_for_create = run_v2.types.Service(
+                    template=service_template_config,
+                    ingress=service_ingress_config
+                )
+                operation = client.create_service(
+                    parent=parent,
+                    service=service_config_for_create,
+                    service_id=service_name
+                )
+                action_taken = "created"
         
-        except Exception as e_check:
-            error_msg = f"Error during service existence check or initial operation for '{service_name}': {str(e_check)}"
-            logging.exception(error_msg)
-            return { "status": "FAILURE", "service_name": service_name, "error_message": error_msg }
+            except Exception as e_check:
+                error_msg = f"Error during service existence check or initial operation for '{service_name}': {str(e_check)}"
+                logger.exception(error_msg)
+                return { "status": "FAILURE", "service_name": service_name, "error_message": error_msg }
 
-        logging.info(f"Deployment operation '{action_taken}' initiated for service '{service_name}'. Waiting for completion...")
-        deployed_service = operation.result(timeout=600)
+            logger.info(f"Deployment operation '{action_taken}' initiated for service '{service_name}'. Waiting for completion...")
+            # Waits for the new revision to be ready; a rollout past DEPLOY_TIMEOUT_SECONDS raises.
+            deployed_service = operation.result(timeout=DEPLOY_TIMEOUT_SECONDS)
 
-        service_url = deployed_service.uri
-        logging.info(f"Service '{service_name}' {action_taken} successfully. URL: {service_url}")
+            service_url = deployed_service.uri
+            logger.info(f"Service '{service_name}' {action_taken} successfully. URL: {service_url}")
+            _remember_deployed_image(service_full_path, image_uri)
 
-        if deployed_service.ingress == run_v2.types.IngressTraffic.INGRESS_TRAFFIC_ALL:
+        if deployed_service.ingress == _INGRESS_ALL and _is_known_public(deployed_service.name):
+            logger.info(f"Service '{service_name}' was confirmed publicly invokable recently; skipping IAM check.")
+        elif deployed_service.ingress == _INGRESS_ALL:
             iam_policy_client = client 
 
             get_iam_request = iam_policy_pb2.GetIamPolicyRequest(resource=deployed_service.name)
@@ -108,7 +245,7 @@ def deploy_to_cloud_run(
             )
 
             if not has_public_binding:
-                logging.info(f"Service '{service_name}' ingress is ALL but not yet publicly invokable. Setting IAM policy...")
+                logger.info(f"Service '{service_name}' ingress is ALL but not yet publicly invokable. Setting IAM policy...")
                 
                 # Create a mutable copy of the policy to modify bindings
                 # The Policy object from google.iam.v1.policy_pb2 is suitable.
@@ -126,27 +263,87 @@ def deploy_to_cloud_run(
                     policy=policy_to_set
                 )
                 iam_policy_client.set_iam_policy(request=set_iam_request)
-                logging.info(f"IAM policy updated for public access to '{service_name}'.")
+                logger.info(f"IAM policy updated for public access to '{service_name}'.")
             else:
-                logging.info(f"Service '{service_name}' is already publicly invokable.")
+                logger.info(f"Service '{service_name}' is already publicly invokable.")
+            _mark_public(deployed_service.name)
 
+        if action_taken == "unchanged":
+            message = f"Service '{service_name}' is already running image '{image_uri}'; no new revision was rolled out."
+        else:
+            message = f"Service '{service_name}' {action_taken} successfully."
         return {
             "status": "SUCCESS",
             "service_name": service_name,
             "service_url": service_url,
-            "message": f"Service '{service_name}' {action_taken} successfully."
+            "message": message
         }
 
+    except concurrent.futures.TimeoutError:
+        # The rollout keeps going server-side; only the wait has ended.
+        error_msg = f"Deployment of service '{service_name}' did not finish within {DEPLOY_TIMEOUT_SECONDS} seconds. The rollout may still complete; check the service status before retrying."
+        logger.error(error_msg)
+        return {"status": "FAILURE", "service_name": service_name, "error_message": error_msg}
     except api_exceptions.PermissionDenied as e:
         error_msg = f"Permission denied during Cloud Run deployment for '{service_name}': {e}. Check DA SA permissions (Cloud Run Admin, Service Account User, roles/iam.serviceAccounts.setIamPolicy on the Run service if applicable)."
-        logging.exception(error_msg)
+        logger.exception(error_msg)
         return {"status": "FAILURE", "service_name": service_name, "error_message": error_msg}
     except Exception as e:
         error_msg = f"An unexpected error occurred during Cloud Run deployment for service '{service_name}': {str(e)}"
-        logging.exception(error_msg)
+        logger.exception(error_msg)
         return { "status": "FAILURE", "service_name": service_name, "error_message": error_msg }
 
 
+async def deploy_many(specs: list[dict], max_concurrency: int = MAX_CONCURRENT_DEPLOYS) -> list[dict]:
+    """
+    Deploys several services to Cloud Run concurrently, with at most max_concurrency rollouts in flight.
+    Each spec is a dict of deploy_to_cloud_run arguments (project_id, region, service_name, image_uri).
+    Returns one result dict per spec, in the same order.
+    """
+    logger.info(f"DA Agent: Deploying {len(specs)} service(s) with up to {max_concurrency} in flight.")
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def _deploy_one(spec: dict) -> dict:
+        async with semaphore:
+            # deploy_to_cloud_run blocks on the rollout, so run it on a worker thread.
+            return await asyncio.to_thread(
+                deploy_to_cloud_run,
+                project_id=spec.get("project_id", ""),
+                region=spec.get("region", ""),
+                service_name=spec.get("service_name", ""),
+                image_uri=spec.get("image_uri", ""),
+            )
+
+    # Two specs for the same service would run update_service against it concurrently and race
+    # on the deployed-image and IAM caches, so only the first spec per service is deployed.
+    keys = [(spec.get("project_id", ""), spec.get("region", ""), spec.get("service_name", "")) for spec in specs]
+    first_index_by_service: dict[tuple[str, str, str], int] = {}
+    for index, key in enumerate(keys):
+        first_index_by_service.setdefault(key, index)
+
+    results = await asyncio.gather(
+        *[_deploy_one(specs[index]) for index in first_index_by_service.values()], return_exceptions=True
+    )
+    results_by_service = dict(zip(first_index_by_service.keys(), results))
+
+    reports = []
+    for index, (spec, key) in enumerate(zip(specs, keys)):
+        service_name = spec.get("service_name", "")
+        if first_index_by_service[key] != index:
+            error_msg = f"Duplicate deploy for service '{service_name}' in this batch; only the first spec for it was deployed."
+            logger.warning(error_msg)
+            reports.append({"status": "ERROR", "service_name": service_name, "error_message": error_msg})
+            continue
+        result = results_by_service[key]
+        # Catch BaseException too: a deploy cancelled mid-batch comes back as CancelledError.
+        if isinstance(result, BaseException):
+            error_msg = f"An unexpected error occurred during Cloud Run deployment for service '{service_name}': {str(result) or type(result).__name__}"
+            logger.error(error_msg)
+            result = {"status": "FAILURE", "service_name": service_name, "error_message": error_msg}
+        reports.append(result)
+    return reports
+
+
 def get_latest_deployed_image(
     project_id: str,
     region: str,
@@ -155,30 +352,30 @@ def get_latest_deployed_image(
     """
     Retrieves the full image URI (with digest) of the latest revision serving traffic for a Cloud Run service.
     """
-    logging.info(f"DA Agent: Getting latest deployed image for service '{service_name}' in '{region}'.")
+    logger.info(f"DA Agent: Getting latest deployed image for service '{service_name}' in '{region}'.")
     try:
-        services_client = run_v2.ServicesClient()
-        revisions_client = run_v2.RevisionsClient() # Client for fetching revision details
+        services_client = _get_services_client(region)
+        revisions_client = _get_revisions_client(region) # Client for fetching revision details
         service_full_path = f"projects/{project_id}/locations/{region}/services/{service_name}"
         
         # Step 1: Get the service object to find its latest revision.
-        service = services_client.get_service(name=service_full_path)
+        service = services_client.get_service(name=service_full_path, metadata=_LATEST_REVISION_METADATA)
         
         # Step 2: Get the name of the latest revision that is ready to serve traffic.
         if not service.latest_ready_revision:
             return {"status": "FAILURE", "error_message": f"Service '{service_name}' has no ready revisions."}
         
         latest_revision_name = service.latest_ready_revision
-        logging.info(f"DA Agent: Found latest ready revision name: {latest_revision_name}")
+        logger.info(f"DA Agent: Found latest ready revision name: {latest_revision_name}")
 
         # Step 3: Get the full Revision object using its name.
-        revision = revisions_client.get_revision(name=latest_revision_name)
+        revision = revisions_client.get_revision(name=latest_revision_name, metadata=_REVISION_IMAGE_METADATA)
 
         # Step 4: The image URI with the resolved digest is in the revision's container spec.
         if revision.containers and revision.containers[0].image:
             image_uri_with_digest = revision.containers[0].image
             if "@sha256:" in image_uri_with_digest:
-                logging.info(f"DA Agent: Found latest deployed image with digest: {image_uri_with_digest}")
+                logger.info(f"DA Agent: Found latest deployed image with digest: {image_uri_with_digest}")
                 return {
                     "status": "SUCCESS",
                     "image_uri_with_digest": image_uri_with_digest,
@@ -191,11 +388,11 @@ def get_latest_deployed_image(
 
     except api_exceptions.NotFound:
         error_msg = f"Service '{service_name}' not found in project '{project_id}' and location '{region}'."
-        logging.error(f"DA Agent: {error_msg}")
+        logger.error(f"DA Agent: {error_msg}")
         return {"status": "ERROR", "error_message": error_msg}
     except Exception as e:
         error_msg = f"An unexpected error occurred while getting the latest image for '{service_name}': {str(e)}"
-        logging.exception(error_msg)
+        logger.exception(error_msg)
         return {"status": "FAILURE", "error_message": error_msg}
     
 def get_service_details(
@@ -206,12 +403,12 @@ def get_service_details(
     """
     Retrieves details for a specific Cloud Run service, including its URL.
     """
-    logging.info(f"DA Agent: Getting details for service '{service_name}' in '{region}'.")
+    logger.info(f"DA Agent: Getting details for service '{service_name}' in '{region}'.")
     try:
-        client = run_v2.ServicesClient()
+        client = _get_services_client(region)
         service_full_path = f"projects/{project_id}/locations/{region}/services/{service_name}"
         
-        service = client.get_service(name=service_full_path)
+        service = client.get_service(name=service_full_path, metadata=_SERVICE_DETAILS_METADATA)
         
         return {
             "status": "SUCCESS",
@@ -222,25 +419,13 @@ def get_service_details(
 
     except api_exceptions.NotFound:
         error_msg = f"Service '{service_name}' not found in project '{project_id}' and location '{region}'."
-        logging.error(f"DA Agent: {error_msg}")
+        logger.error(f"DA Agent: {error_msg}")
         return {"status": "ERROR", "error_message": error_msg}
     except Exception as e:
         error_msg = f"An unexpected error occurred while getting details for '{service_name}': {str(e)}"
-        logging.exception(error_msg)
+        logger.exception(error_msg)
         return {"status": "FAILURE", "error_message": error_msg}
     
-# --- ADK Agent Definition ---
-da_agent = Agent(
-    name="geminiflow_deployment_agent",
-    description="An agent responsible for deploying containerized applications to runtime environments like Cloud Run and retrieving information about current deployments.",
-    instruction=(
-        "You are a Deployment Agent. You receive requests to deploy specified container images "
-        "to target environments (like Cloud Run) and report back the deployment status and service URL. "
-        "You can also retrieve details like the URL or the image URI of a service."
-    ),
-    tools=[deploy_to_cloud_run, get_latest_deployed_image, get_service_details],
-)
-    
 # --- ADK Agent Definition ---
 da_agent = Agent(
     name="geminiflow_deployment_agent",
@@ -249,11 +434,12 @@ da_agent = Agent(
         "You are a Deployment Agent. You receive requests to deploy specified container images "
         "to target environments (like Cloud Run) and report back the deployment status and service URL."
     ),
-    tools=[deploy_to_cloud_run, get_latest_deployed_image],
+    tools=[deploy_to_cloud_run, deploy_many, get_latest_deployed_image],
 )
 
 # --- Local Testing Example ---
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     if not GCP_PROJECT_ID:
         print("Error: GOOGLE_CLOUD_PROJECT environment variable is not set.")
     else:
@@ -2,15 +2,16 @@
 # Agent Development Kit (ADK) FinOps Agent for GeminiFlow
 
 import os
+import time
 import logging
+import threading
 from datetime import datetime, timedelta, timezone
 from google.adk.agents import Agent # Or LlmAgent if you add Gemini summarization
 from google.cloud import bigquery
 from dotenv import load_dotenv
 load_dotenv()
 
-# Configure basic logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # --- FinOps Agent Configuration ---
 # For local testing, ensure GOOGLE_APPLICATION_CREDENTIALS is set to the path of
@@ -21,134 +22,209 @@ GCP_PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
 # e.g., "your-billing-project.your_billing_dataset.gcp_billing_export_v1_XXXXXX_XXXXXX_XXXXXX"
 BIGQUERY_BILLING_TABLE = os.getenv("BIGQUERY_BILLING_TABLE", "your-project.your_dataset.gcp_billing_export_v1_XXXX") # REPLACE
 
+# --- Shared Clients ---
+# One BigQuery client per billing project, reused so its HTTP session and credentials
+# are not rebuilt for every query.
+_BQ_CLIENTS: dict[str, bigquery.Client] = {}
+_CLIENT_LOCK = threading.Lock()
+
+def _get_bigquery_client(project_id: str) -> bigquery.Client:
+    """Returns the process-wide BigQuery client for project_id, creating it on first use."""
+    client = _BQ_CLIENTS.get(project_id)
+    if client is None:
+        with _CLIENT_LOCK:
+            client = _BQ_CLIENTS.get(project_id)
+            if client is None:
+                client = bigquery.Client(project=project_id)
+                _BQ_CLIENTS[project_id] = client
+    return client
+
+def warm_clients() -> None:
+    """Creates the shared BigQuery client ahead of the first query (e.g. at server startup)."""
+    if GCP_PROJECT_ID:
+        _get_bigquery_client(GCP_PROJECT_ID)
+
+# --- Result Cache ---
+# The billing export only refreshes every few hours, so identical questions asked
+# within FINOPS_CACHE_TTL_SECONDS are answered from memory instead of re-running the
+# query. Keys include the project and table so changing either never serves stale rows.
+FINOPS_CACHE_TTL_SECONDS = int(os.getenv("FINOPS_CACHE_TTL_SECONDS", "900"))
+_COST_SUMMARY_CACHE: dict[tuple, tuple[float, dict]] = {}
+_COST_SUMMARY_CACHE_LOCK = threading.Lock()
+
+def _copy_summary(summary: dict) -> dict:
+    """Copies a cost summary down to its breakdown rows, so callers and the cache never share them."""
+    copied = dict(summary)
+    if "cost_breakdown" in copied:
+        copied["cost_breakdown"] = [dict(row) for row in copied["cost_breakdown"]]
+    return copied
+
+def _get_cached_summary(key: tuple) -> dict | None:
+    """Returns a copy of the cached cost summary for key if it is younger than the TTL."""
+    with _COST_SUMMARY_CACHE_LOCK:
+        entry = _COST_SUMMARY_CACHE.get(key)
+    if entry is None or time.monotonic() - entry[0] >= FINOPS_CACHE_TTL_SECONDS:
+        return None
+    return _copy_summary(entry[1])
+
+def _cache_summary(key: tuple, summary: dict) -> None:
+    """Stores a successful cost summary under key."""
+    with _COST_SUMMARY_CACHE_LOCK:
+        _COST_SUMMARY_CACHE[key] = (time.monotonic(), _copy_summary(summary))
+
 # --- FinOps Agent Tools ---
 
-def get_total_project_cost(days_ago: int = 7) -> dict:
+def get_cost_summary(days_ago: int = 7, limit: int = 5) -> dict:
     """
-    Queries BigQuery to calculate the total cost for the current GCP project over a specified number of past days.
+    Queries BigQuery once for both the total cost and the top N most expensive services
+    for the current GCP project over a specified number of past days.
+
+    The billing export is filtered in a single CTE that feeds both the total and the
+    per-service breakdown, so the table is scanned (and billed) once instead of twice.
 
     Args:
         days_ago (int): The number of days to look back for cost data. Defaults to 7.
+        limit (int): The number of top services to return. Defaults to 5.
 
     Returns:
-        dict: A dictionary containing the status, total cost, and time window.
+        dict: A dictionary containing the status, total cost, per-service breakdown and time window.
     """
     if BIGQUERY_BILLING_TABLE == "your-project.your_dataset.gcp_billing_export_v1_XXXX":
         return {"status": "ERROR", "error_message": "BIGQUERY_BILLING_TABLE environment variable not set."}
     if not GCP_PROJECT_ID:
         return {"status": "ERROR", "error_message": "GCP_PROJECT_ID environment variable not set."}
 
-    logging.info(f"FinOps: Calculating total cost for project '{GCP_PROJECT_ID}' for the last {days_ago} days.")
-    client = bigquery.Client(project=GCP_PROJECT_ID)
+    cache_key = (GCP_PROJECT_ID, BIGQUERY_BILLING_TABLE, days_ago, limit)
+    cached = _get_cached_summary(cache_key)
+    if cached is not None:
+        logger.info(f"FinOps: Serving cached cost summary for project '{GCP_PROJECT_ID}' (last {days_ago} days, top {limit}).")
+        return cached
 
-    # Calculate the start date for the query
-    start_date = (datetime.now(timezone.utc) - timedelta(days=days_ago)).strftime('%Y-%m-%d')
+    logger.info(f"FinOps: Calculating cost summary (top {limit} services) for project '{GCP_PROJECT_ID}' for the last {days_ago} days.")
+    client = _get_bigquery_client(GCP_PROJECT_ID)
+
+    # Calculate the start of the query window (midnight UTC, days_ago days back)
+    start_date = (datetime.now(timezone.utc) - timedelta(days=days_ago)).replace(hour=0, minute=0, second=0, microsecond=0)
 
     query = f"""
-        SELECT
-          SUM(cost) AS total_cost
-        FROM
-          `{BIGQUERY_BILLING_TABLE}`
-        WHERE
-          project.id = @project_id
-          AND usage_start_time >= @start_date
+        WITH filtered AS (
+          SELECT
+            service.description AS service_name,
+            cost
+          FROM
+            `{BIGQUERY_BILLING_TABLE}`
+          WHERE
+            -- The billing export is partitioned on export time, which is never earlier
+            -- than usage time, so this lets BigQuery prune older partitions up front.
+            _PARTITIONTIME >= TIMESTAMP_TRUNC(@start_date, DAY)
+            AND usage_start_time >= @start_date
+            AND project.id = @project_id
+        ),
+        by_service AS (
+          SELECT
+            service_name,
+            SUM(cost) AS total_cost
+          FROM
+            filtered
+          GROUP BY
+            service_name
+          ORDER BY
+            total_cost DESC
+          LIMIT @limit
+        )
+        SELECT 'total' AS kind, CAST(NULL AS STRING) AS service_name, SUM(cost) AS total_cost FROM filtered
+        UNION ALL
+        SELECT 'service' AS kind, service_name, total_cost FROM by_service
     """
-    
+
     job_config = bigquery.QueryJobConfig(
         query_parameters=[
             bigquery.ScalarQueryParameter("project_id", "STRING", GCP_PROJECT_ID),
-            bigquery.ScalarQueryParameter("start_date", "STRING", start_date),
+            bigquery.ScalarQueryParameter("start_date", "TIMESTAMP", start_date),
+            bigquery.ScalarQueryParameter("limit", "INT64", limit),
         ]
     )
 
     try:
         query_job = client.query(query, job_config=job_config)
-        results = query_job.result() # Waits for the job to complete
+        # Waits for the job to complete. The query yields at most one total row plus `limit`
+        # service rows, so capping max_results lets the client read them in a single page.
+        results = query_job.result(max_results=limit + 1)
 
         total_cost = 0
+        services = []
         for row in results:
-            total_cost = row.total_cost if row.total_cost else 0
-        
+            if row.kind == "total":
+                total_cost = row.total_cost if row.total_cost else 0
+            else:
+                services.append((row.service_name, row.total_cost or 0))
+
+        # UNION ALL does not preserve the order of by_service, so re-sort here.
+        services.sort(key=lambda item: item[1], reverse=True)
+        cost_breakdown = [
+            {"service_name": name, "total_cost": f"${cost:.2f}"}
+            for name, cost in services
+        ]
+
         message = f"Total cost for project '{GCP_PROJECT_ID}' over the last {days_ago} days is approximately ${total_cost:.2f}."
-        logging.info(f"FinOps: {message}")
-        return {
+        logger.info(f"FinOps: {message}")
+        summary = {
             "status": "SUCCESS",
             "total_cost": f"${total_cost:.2f}",
+            "cost_breakdown": cost_breakdown,
             "days_ago": days_ago,
             "message": message
         }
+        _cache_summary(cache_key, summary)
+        return summary
     except Exception as e:
-        error_msg = f"FinOps: BigQuery query failed for total project cost: {e}"
-        logging.exception(error_msg)
+        error_msg = f"FinOps: BigQuery query failed for cost summary: {e}"
+        logger.exception(error_msg)
         return {"status": "ERROR", "error_message": error_msg}
 
 
-def get_cost_by_service(days_ago: int = 7, limit: int = 5) -> dict:
+def get_total_project_cost(days_ago: int = 7) -> dict:
     """
-    Queries BigQuery for the top N most expensive services for the current GCP project
-    over a specified number of past days.
+    Queries BigQuery to calculate the total cost for the current GCP project over a specified number of past days.
 
     Args:
         days_ago (int): The number of days to look back for cost data. Defaults to 7.
-        limit (int): The number of top services to return. Defaults to 5.
 
     Returns:
-        dict: A dictionary containing the status and a list of services with their costs.
+        dict: A dictionary containing the status, total cost, and time window.
     """
-    if BIGQUERY_BILLING_TABLE == "your-project.your_dataset.gcp_billing_export_v1_XXXX":
-        return {"status": "ERROR", "error_message": "BIGQUERY_BILLING_TABLE environment variable not set."}
-    if not GCP_PROJECT_ID:
-        return {"status": "ERROR", "error_message": "GCP_PROJECT_ID environment variable not set."}
+    summary = get_cost_summary(days_ago=days_ago)
+    if summary.get("status") != "SUCCESS":
+        return summary
+    return {
+        "status": "SUCCESS",
+        "total_cost": summary["total_cost"],
+        "days_ago": days_ago,
+        "message": summary["message"]
+    }
 
-    logging.info(f"FinOps: Getting top {limit} services by cost for project '{GCP_PROJECT_ID}' for the last {days_ago} days.")
-    client = bigquery.Client(project=GCP_PROJECT_ID)
-    start_date = (datetime.now(timezone.utc) - timedelta(days=days_ago)).strftime('%Y-%m-%d')
 
-    query = f"""
-        SELECT
-          service.description AS service_name,
-          SUM(cost) AS total_cost
-        FROM
-          `{BIGQUERY_BILLING_TABLE}`
-        WHERE
-          project.id = @project_id
-          AND usage_start_time >= @start_date
-        GROUP BY
-          service_name
-        ORDER BY
-          total_cost DESC
-        LIMIT @limit
+def get_cost_by_service(days_ago: int = 7, limit: int = 5) -> dict:
     """
+    Queries BigQuery for the top N most expensive services for the current GCP project
+    over a specified number of past days.
 
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("project_id", "STRING", GCP_PROJECT_ID),
-            bigquery.ScalarQueryParameter("start_date", "STRING", start_date),
-            bigquery.ScalarQueryParameter("limit", "INT64", limit),
-        ]
-    )
-
-    try:
-        query_job = client.query(query, job_config=job_config)
-        results = query_job.result()
+    Args:
+        days_ago (int): The number of days to look back for cost data. Defaults to 7.
+        limit (int): The number of top services to return. Defaults to 5.
 
-        cost_breakdown = []
-        for row in results:
-            cost_breakdown.append({
-                "service_name": row.service_name,
-                "total_cost": f"${row.total_cost:.2f}"
-            })
-        
-        logging.info(f"FinOps: Successfully fetched cost breakdown by service.")
-        return {
-            "status": "SUCCESS",
-            "cost_breakdown": cost_breakdown,
-            "message": f"Successfully fetched cost breakdown for the top {limit} services."
-        }
-    except Exception as e:
-        error_msg = f"FinOps: BigQuery query failed for cost by service: {e}"
-        logging.exception(error_msg)
-        return {"status": "ERROR", "error_message": error_msg}
+    Returns:
+        dict: A dictionary containing the status and a list of services with their costs.
+    """
+    summary = get_cost_summary(days_ago=days_ago, limit=limit)
+    if summary.get("status") != "SUCCESS":
+        return summary
+    logger.info(f"FinOps: Successfully fetched cost breakdown by service.")
+    return {
+        "status": "SUCCESS",
+        "cost_breakdown": summary["cost_breakdown"],
+        "message": f"Successfully fetched cost breakdown for the top {limit} services."
+    }
 
 
 # --- ADK Agent Definition ---
@@ -159,6 +235,7 @@ finops_agent = Agent(
     description="An agent that provides financial operations (FinOps) insights by querying billing data from BigQuery.",
     instruction="You are a FinOps Agent. You answer questions about project costs by querying billing data.",
     tools=[
+        get_cost_summary,
         get_total_project_cost,
         get_cost_by_service,
     ],
@@ -166,6 +243,7 @@ finops_agent = Agent(
 
 # --- Local Testing Example ---
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     # Before running:
     # 1. Install the BigQuery client library: `pip install google-cloud-bigquery python-dotenv`
     # 2. Set the GOOGLE_APPLICATION_CREDENTIALS environment variable to the path of your
@@ -3,11 +3,18 @@
 
 import os
 import re
+import gzip
+import hashlib
 import logging
 import time
+import random
+import threading
+import concurrent.futures
+from collections import OrderedDict
 from google.adk.agents import LlmAgent
 from google.cloud.devtools import cloudbuild_v1
 from google.cloud import storage
+from google.api_core import exceptions as api_exceptions
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -22,49 +29,123 @@ TERRAFORM_TRIGGER_ID = os.getenv("TERRAFORM_TRIGGER_ID", "terraform-plan-and-app
 TERRAFORM_LOGS_BUCKET = os.getenv("TERRAFORM_LOGS_BUCKET", "gemini-flow-build-artifacts")
 GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.0-flash-exp")
 VERTEX_AI_LOCATION = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
+TERRAFORM_BUILD_TIMEOUT_SECONDS = int(os.getenv("INFRA_TERRAFORM_TIMEOUT_SECONDS", "1800")) # Deadline for a Terraform build
+LOG_POLL_INITIAL_SECONDS = 1.0 # First wait for the build log to appear; doubles per attempt
+LOG_POLL_MAX_SECONDS = 15.0 # Cap for a single wait
+LOG_WAIT_SECONDS = 60.0 # Total wait budget for the build log before giving up
+MAX_SUMMARY_LOG_CHARS = 2000 # Tail of the log sent to Gemini; plan/apply results and errors are printed last
+SUMMARY_CACHE_SIZE = 128 # Number of Gemini summaries kept for re-summarized logs
+LOG_PARSE_TAIL_CHARS = 16384 # The plan summary is printed at the end of the log, so parse this much first
 
-# Configure Gemini properly - use either Vertex AI or direct API
-gemini_client = None
-if os.getenv("GEMINI_API_KEY"):
-    try:
-        import google.generativeai as genai
-        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-        gemini_client = genai
-        logging.info(f"Infra Agent: Gemini client configured with API key.")
-    except Exception as e_genai:
-        logging.warning(f"Infra Agent: Could not configure Gemini with API key: {e_genai}")
-elif GCP_PROJECT_ID and VERTEX_AI_LOCATION:
-    try:
-        import vertexai
-        from vertexai.generative_models import GenerativeModel
-        vertexai.init(project=GCP_PROJECT_ID, location=VERTEX_AI_LOCATION)
-        gemini_client = "vertex"
-        logging.info(f"Infra Agent: Vertex AI client configured.")
-    except Exception as e_vertex:
-        logging.warning(f"Infra Agent: Could not configure Vertex AI client: {e_vertex}")
-else:
-    logging.warning("Infra Agent: Neither GEMINI_API_KEY nor GCP credentials configured. Summarization disabled.")
+# Patterns used to pull results out of Terraform logs, compiled once.
+_PLAN_SUMMARY_RE = re.compile(r"Plan: (\d+ to add, \d+ to change, \d+ to destroy\.)")
+_SERVICE_URL_QUOTED_RE = re.compile(r'service_url\s*=\s*"(https://[^"]+)"')
+_SERVICE_URL_BARE_RE = re.compile(r'service_url\s*=\s*(https://\S+)')
+
+# Configure Gemini properly - use either Vertex AI or direct API.
+# Both SDKs are slow to import, so the backend is set up on the first summary request
+# rather than at module load. The outcome (including "unavailable") is remembered.
+_GEMINI_CLIENT = None
+_GEMINI_CLIENT_RESOLVED = False
+_GEMINI_LOCK = threading.Lock()
+
+def _get_gemini_client():
+    """Returns the configured google.generativeai module, "vertex" for Vertex AI, or None if neither is available."""
+    global _GEMINI_CLIENT, _GEMINI_CLIENT_RESOLVED
+    if _GEMINI_CLIENT_RESOLVED:
+        return _GEMINI_CLIENT
+    with _GEMINI_LOCK:
+        if _GEMINI_CLIENT_RESOLVED:
+            return _GEMINI_CLIENT
+        if os.getenv("GEMINI_API_KEY"):
+            try:
+                import google.generativeai as genai
+                genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+                _GEMINI_CLIENT = genai
+                logging.info(f"Infra Agent: Gemini client configured with API key.")
+            except Exception as e_genai:
+                logging.warning(f"Infra Agent: Could not configure Gemini with API key: {e_genai}")
+        elif GCP_PROJECT_ID and VERTEX_AI_LOCATION:
+            try:
+                import vertexai
+                vertexai.init(project=GCP_PROJECT_ID, location=VERTEX_AI_LOCATION)
+                _GEMINI_CLIENT = "vertex"
+                logging.info(f"Infra Agent: Vertex AI client configured.")
+            except Exception as e_vertex:
+                logging.warning(f"Infra Agent: Could not configure Vertex AI client: {e_vertex}")
+        else:
+            logging.warning("Infra Agent: Neither GEMINI_API_KEY nor GCP credentials configured. Summarization disabled.")
+        _GEMINI_CLIENT_RESOLVED = True
+    return _GEMINI_CLIENT
+
+# --- Shared Clients ---
+# Every plan or apply submits a Terraform build, then reads its log and writes the
+# archive copy. Both clients are built once per process instead of once per run.
+_STORAGE_CLIENT = None
+_BUILD_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+def _get_storage_client() -> storage.Client:
+    """Returns the Cloud Storage client for reading Terraform logs and writing their archives."""
+    global _STORAGE_CLIENT
+    if _STORAGE_CLIENT is None:
+        with _CLIENT_LOCK:
+            if _STORAGE_CLIENT is None:
+                _STORAGE_CLIENT = storage.Client(project=GCP_PROJECT_ID)
+    return _STORAGE_CLIENT
+
+def _get_build_client() -> cloudbuild_v1.CloudBuildClient:
+    """Returns the Cloud Build client that runs the Terraform trigger."""
+    global _BUILD_CLIENT
+    if _BUILD_CLIENT is None:
+        with _CLIENT_LOCK:
+            if _BUILD_CLIENT is None:
+                _BUILD_CLIENT = cloudbuild_v1.CloudBuildClient()
+    return _BUILD_CLIENT
+
+# --- Summary Cache ---
+# Planning the same change twice yields the same Terraform output tail and so the same
+# prompt. Summaries are stored by prompt hash, keeping the SUMMARY_CACHE_SIZE most recent.
+_SUMMARY_CACHE: OrderedDict[str, str] = OrderedDict()
+_SUMMARY_CACHE_LOCK = threading.Lock()
+
+def _get_cached_summary(prompt_hash: str) -> str | None:
+    """Returns the cached summary for prompt_hash, marking it as recently used."""
+    with _SUMMARY_CACHE_LOCK:
+        summary = _SUMMARY_CACHE.get(prompt_hash)
+        if summary is not None:
+            _SUMMARY_CACHE.move_to_end(prompt_hash)
+        return summary
+
+def _cache_summary(prompt_hash: str, summary: str) -> None:
+    """Stores a successful summary, evicting the least recently used one when full."""
+    with _SUMMARY_CACHE_LOCK:
+        _SUMMARY_CACHE[prompt_hash] = summary
+        if len(_SUMMARY_CACHE) > SUMMARY_CACHE_SIZE:
+            _SUMMARY_CACHE.popitem(last=False)
 
 # --- Infrastructure Agent Tools ---
 
-def _save_log_archive(log_content: str, build_id: str, command: str) -> None:
+def _save_log_archive(log_content: bytes, build_id: str, command: str) -> None:
     """Saves a copy of the log content to the designated TERRAFORM_LOGS_BUCKET for archival."""
     if not TERRAFORM_LOGS_BUCKET:
         logging.warning("Infra Agent: TERRAFORM_LOGS_BUCKET not set. Skipping log archival.")
         return
     try:
-        storage_client = storage.Client(project=GCP_PROJECT_ID)
+        storage_client = _get_storage_client()
         bucket = storage_client.bucket(TERRAFORM_LOGS_BUCKET)
         object_name = f"terraform-logs/{command}/{build_id}/terraform_log.txt"
         blob = bucket.blob(object_name)
-        blob.upload_from_string(log_content)
+        # Terraform output compresses very well; GCS decompresses it transparently on download.
+        blob.content_encoding = "gzip"
+        blob.upload_from_string(gzip.compress(log_content), content_type="text/plain; charset=utf-8")
         logging.info(f"Infra Agent: Saved log archive to gs://{TERRAFORM_LOGS_BUCKET}/{object_name}")
     except Exception as e:
         logging.error(f"Infra Agent: Failed to save log archive to TERRAFORM_LOGS_BUCKET: {e}")
 
-def _get_build_logs(build_result) -> str | None:
+def _get_build_logs(build_result) -> bytes | None:
     """
-    Directly retrieves logs from the build's GCS bucket.
+    Directly retrieves the raw log bytes from the build's GCS bucket.
     Includes a retry mechanism to wait for the log file to become available.
     """
     build_id = build_result.id
@@ -81,33 +162,49 @@ def _get_build_logs(build_result) -> str | None:
         # The log file is consistently named log-{build_id}.txt at the root of the log path.
         log_file_name = f"log-{build_id}.txt"
         
-        storage_client = storage.Client(project=GCP_PROJECT_ID)
+        storage_client = _get_storage_client()
         source_bucket = storage_client.bucket(bucket_name)
         source_blob = source_bucket.blob(log_file_name)
 
-        log_content = None
         # Retry logic: It can take a few moments for the log file to appear after the build completes.
-        for attempt in range(6): # Try for up to 60 seconds
-            if source_blob.exists():
+        # Back off exponentially (with jitter) so a log that lands quickly is picked up within a
+        # second or two, while the total wait stays within LOG_WAIT_SECONDS.
+        delay = LOG_POLL_INITIAL_SECONDS
+        waited = 0.0
+        while True:
+            # Download directly; a missing object surfaces as NotFound, so no separate exists() probe is needed.
+            try:
+                log_content = source_blob.download_as_bytes()
                 logging.info(f"Infra Agent: Found log file at gs://{bucket_name}/{log_file_name}.")
-                log_content = source_blob.download_as_text()
-                break
-            logging.info(f"Infra Agent: Log not yet available at gs://{bucket_name}/{log_file_name}. Waiting 10s... (Attempt {attempt+1}/6)")
-            time.sleep(10)
-        
-        return log_content
+                return log_content
+            except api_exceptions.NotFound:
+                pass
+            if waited >= LOG_WAIT_SECONDS:
+                logging.warning(f"Infra Agent: Log did not appear at gs://{bucket_name}/{log_file_name} within {LOG_WAIT_SECONDS:.0f}s.")
+                return None
+            logging.info(f"Infra Agent: Log not yet available at gs://{bucket_name}/{log_file_name}. Waiting {delay:.0f}s...")
+            time.sleep(delay * random.uniform(0.8, 1.2))
+            waited += delay
+            delay = min(delay * 2, LOG_POLL_MAX_SECONDS)
 
     except Exception as e:
         logging.error(f"Infra Agent: An error occurred while retrieving logs for build {build_id}: {e}")
         return None
+def _search_from(pattern: re.Pattern, text: str, start: int):
+    """Searches text from start, falling back to the whole text if nothing matches there."""
+    match = pattern.search(text, start)
+    if match is None and start > 0:
+        match = pattern.search(text)
+    return match
+
 def _parse_terraform_log(log_text: str, command: str) -> str:
     """Parses Terraform logs to find the plan summary or apply output."""
     if not log_text:
         return f"Could not retrieve logs to parse for Terraform {command} result."
 
     if command == "plan":
-        # Look for the "Plan: X to add, Y to change, Z to destroy." line
-        match = re.search(r"Plan: (\d+ to add, \d+ to change, \d+ to destroy\.)", log_text)
+        # Look for the "Plan: X to add, Y to change, Z to destroy." line near the end of the log
+        match = _search_from(_PLAN_SUMMARY_RE, log_text, max(0, len(log_text) - LOG_PARSE_TAIL_CHARS))
         if match:
             return f"Terraform Plan Summary: {match.group(1)}"
         return "Terraform plan ran, but summary line could not be found in logs."
@@ -115,12 +212,14 @@ def _parse_terraform_log(log_text: str, command: str) -> str:
     if command == "apply -auto-approve":
         # Look for the "Outputs:" section and the service_url - improved regex
         # The logs show: service_url = "https://staging-service-1750243796-cdoz2wv6ia-uc.a.run.app"
-        match = re.search(r'service_url\s*=\s*"(https://[^"]+)"', log_text)
+        # Apply prints its outputs last, so only the final "Outputs:" block is scanned first.
+        outputs_start = max(0, log_text.rfind("Outputs:"))
+        match = _search_from(_SERVICE_URL_QUOTED_RE, log_text, outputs_start)
         if match:
             return f"Terraform apply complete. New service URL: {match.group(1)}"
         
         # Alternative patterns to try
-        match = re.search(r'service_url\s*=\s*(https://\S+)', log_text)
+        match = _search_from(_SERVICE_URL_BARE_RE, log_text, outputs_start)
         if match:
             return f"Terraform apply complete. New service URL: {match.group(1)}"
             
@@ -137,6 +236,7 @@ def _summarize_terraform_output_with_gemini(log_text: str, command: str) -> str:
     if not log_text:
         return "No log content available for summarization."
         
+    gemini_client = _get_gemini_client()
     if not gemini_client:
         logging.warning("Infra Agent: Gemini client not configured, cannot summarize terraform output.")
         return "Gemini summarization not available."
@@ -146,8 +246,13 @@ def _summarize_terraform_output_with_gemini(log_text: str, command: str) -> str:
 Be concise and highlight the key changes, resources affected, and any important outputs or warnings:
 
 Terraform {command} output:
-{log_text[:2000]}
+{log_text[-MAX_SUMMARY_LOG_CHARS:]}
 """
+        prompt_hash = hashlib.sha256(f"{GEMINI_MODEL_NAME}|{prompt}".encode("utf-8")).hexdigest()
+        cached = _get_cached_summary(prompt_hash)
+        if cached is not None:
+            logging.info(f"Infra Agent: Reusing cached Gemini summary for terraform {command} output.")
+            return cached
         
         logging.info(f"Infra Agent: Sending terraform {command} output to Gemini for summarization...")
         
@@ -164,17 +269,24 @@ Terraform {command} output:
             summary = response.text
             
         logging.info("Infra Agent: Gemini summarization successful.")
+        _cache_summary(prompt_hash, summary)
         return summary
         
     except Exception as e:
         logging.error(f"Infra Agent: Error during Gemini summarization: {e}")
         return f"Could not summarize terraform output due to an error: {e}."
 
-def _run_terraform_trigger(command: str, new_service_name: str, deployment_image_uri: str, region: str) -> dict:
+def _run_terraform_trigger(
+    command: str,
+    new_service_name: str,
+    deployment_image_uri: str,
+    region: str,
+    timeout_seconds: int = TERRAFORM_BUILD_TIMEOUT_SECONDS
+) -> dict:
     """Helper function to run the Terraform trigger and process results."""
     logging.info(f"Infra Agent: Invoking Terraform trigger for command '{command}' on service '{new_service_name}'.")
     
-    client = cloudbuild_v1.CloudBuildClient()
+    client = _get_build_client()
 
     source = cloudbuild_v1.types.RepoSource(
         repo_name=TERRAFORM_SOURCE_REPO,
@@ -193,18 +305,21 @@ def _run_terraform_trigger(command: str, new_service_name: str, deployment_image
             trigger_id=TERRAFORM_TRIGGER_ID,
             source=source
         )
-        result = operation.result()
+        # Blocks until the Terraform build finishes; a run longer than timeout_seconds raises here.
+        result = operation.result(timeout=timeout_seconds)
         build_id = result.id
         log_url = result.log_url
         logging.info(f"Infra Agent: Terraform trigger run completed. Status: {result.status}. Logs at: {log_url}")
 
         # Get logs using the new simplified and robust function
-        log_text = _get_build_logs(result)
+        log_bytes = _get_build_logs(result)
+        # Decode once for parsing and summarization; the archive is written from the raw bytes.
+        log_text = log_bytes.decode("utf-8", errors="replace") if log_bytes is not None else None
 
         if result.status == cloudbuild_v1.Build.Status.SUCCESS:
             if log_text:
                 # Save a copy for our records
-                _save_log_archive(log_text, build_id, command)
+                _save_log_archive(log_bytes, build_id, command)
                 
                 # Parse and analyze logs
                 parsed_message = _parse_terraform_log(log_text, command)
@@ -235,7 +350,7 @@ def _run_terraform_trigger(command: str, new_service_name: str, deployment_image
             error_message = f"Terraform {command} build failed. Check logs for details: {log_url}"
             if log_text:
                 # If we got logs for the failure, add a summary
-                _save_log_archive(log_text, build_id, command)
+                _save_log_archive(log_bytes, build_id, command)
                 ai_summary = _summarize_terraform_output_with_gemini(log_text, command)
                 error_message += f"\n\nAI Analysis of Failure:\n{ai_summary}"
 
@@ -247,6 +362,11 @@ def _run_terraform_trigger(command: str, new_service_name: str, deployment_image
                 "log_retrieved": log_text is not None,
             }
 
+    except concurrent.futures.TimeoutError:
+        # The build keeps running in Cloud Build; only the wait has ended.
+        error_msg = f"Infra Agent: Terraform {command} build did not finish within {timeout_seconds} seconds. It may still complete; check Cloud Build before retrying."
+        logging.error(error_msg)
+        return {"status": "FAILURE", "error_message": error_msg, "log_retrieved": False}
     except Exception as e:
         error_msg = f"Infra Agent: Failed to run Terraform trigger: {e}"
         logging.exception(error_msg)
@@ -255,27 +375,31 @@ def _run_terraform_trigger(command: str, new_service_name: str, deployment_image
 def run_terraform_plan(
     new_service_name: str,
     deployment_image_uri: str,
-    region: str = "us-central1"
+    region: str = "us-central1",
+    timeout_seconds: int = TERRAFORM_BUILD_TIMEOUT_SECONDS
 ) -> dict:
     """Runs 'terraform plan' via a Cloud Build trigger and returns a summary of the plan."""
     return _run_terraform_trigger(
         command="plan",
         new_service_name=new_service_name,
         deployment_image_uri=deployment_image_uri,
-        region=region
+        region=region,
+        timeout_seconds=timeout_seconds
     )
 
 def run_terraform_apply(
     new_service_name: str,
     deployment_image_uri: str,
-    region: str = "us-central1"
+    region: str = "us-central1",
+    timeout_seconds: int = TERRAFORM_BUILD_TIMEOUT_SECONDS
 ) -> dict:
     """Runs 'terraform apply' via a Cloud Build trigger and returns the new service URL."""
     return _run_terraform_trigger(
         command="apply -auto-approve",
         new_service_name=new_service_name,
         deployment_image_uri=deployment_image_uri,
-        region=region
+        region=region,
+        timeout_seconds=timeout_seconds
     )
 
 # --- ADK Agent Definition ---
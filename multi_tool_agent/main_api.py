@@ -55,6 +55,20 @@ async def startup_event():
     else:
         logging.critical("Runner could not be initialized due to import errors.")
 
+    # Build the DA and FinOps clients at container boot rather than on the first tool call,
+    # so credential discovery and client setup are done before the first request arrives.
+    # The gRPC channels themselves still connect on their first RPC. The Cloud Run clients
+    # are regional, so they are built for the region the orchestrator deploys to.
+    try:
+        import agent
+        import da_agent
+        import finops_agent
+        await asyncio.to_thread(da_agent.warm_clients, agent.TARGET_APP_CLOUD_RUN_REGION)
+        await asyncio.to_thread(finops_agent.warm_clients)
+        logging.info("DA and FinOps clients warmed up.")
+    except Exception as e:
+        logging.warning(f"Could not warm up agent clients; they will be created on first use. Error: {e}")
+
 
 # Construct an absolute path to the 'static' directory
 STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
@@ -8,7 +8,6 @@ from datetime import timedelta
 from google.adk.agents import LlmAgent
 from google.cloud.devtools import containeranalysis_v1
 
-import google.generativeai as genai
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -24,17 +23,28 @@ GCP_PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
 GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.0-flash")
 VERTEX_AI_LOCATION = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
 
-if GCP_PROJECT_ID and VERTEX_AI_LOCATION:
-    try:
-        genai.configure(
-            api_key=os.getenv("GEMINI_API_KEY"), # Optional, will use ADC if not set
-            client_options={"api_endpoint": f"{VERTEX_AI_LOCATION}-aiplatform.googleapis.com"}
-        )
-        logging.info(f"Security Agent: Gemini client configured for project {GCP_PROJECT_ID} and location {VERTEX_AI_LOCATION}")
-    except Exception as e_genai:
-        logging.warning(f"Security Agent: Could not configure Gemini client: {e_genai}. Summarization might fail.")
-else:
-    logging.warning("Security Agent: GCP_PROJECT_ID or VERTEX_AI_LOCATION not set. Gemini client for summarization not configured.")
+# google.generativeai pulls in a large dependency tree and is only needed for summaries,
+# so it is imported and configured on first use rather than at module load.
+_GENAI = None
+
+def _get_genai():
+    """Returns the google.generativeai module, importing and configuring it on first use."""
+    global _GENAI
+    if _GENAI is None:
+        import google.generativeai as genai
+        if GCP_PROJECT_ID and VERTEX_AI_LOCATION:
+            try:
+                genai.configure(
+                    api_key=os.getenv("GEMINI_API_KEY"), # Optional, will use ADC if not set
+                    client_options={"api_endpoint": f"{VERTEX_AI_LOCATION}-aiplatform.googleapis.com"}
+                )
+                logging.info(f"Security Agent: Gemini client configured for project {GCP_PROJECT_ID} and location {VERTEX_AI_LOCATION}")
+            except Exception as e_genai:
+                logging.warning(f"Security Agent: Could not configure Gemini client: {e_genai}. Summarization might fail.")
+        else:
+            logging.warning("Security Agent: GCP_PROJECT_ID or VERTEX_AI_LOCATION not set. Gemini client for summarization not configured.")
+        _GENAI = genai
+    return _GENAI
 
 
 # --- Security Agent Tools ---
@@ -126,7 +136,7 @@ def summarize_vulnerabilities_with_gemini(scan_results: dict) -> str:
     
     try:
         logging.info("Security Agent: Sending vulnerability data to Gemini for summarization...")
-        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+        model = _get_genai().GenerativeModel(GEMINI_MODEL_NAME)
         response = model.generate_content(prompt)
         summary = response.text.strip()
         logging.info("Security Agent: Gemini summarization successful.")
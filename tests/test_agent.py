@@ -1,6 +1,7 @@
 # tests/test_agent.py
 
 import pytest
+import asyncio
 from unittest.mock import patch
 
 # Adjust the path to find your agent files
@@ -9,7 +10,7 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'multi_tool_agent')))
 
 # Import the tool functions from the main agent.py to be tested
-from agent import execute_smart_deploy_workflow, execute_health_check_workflow
+from agent import execute_smart_deploy_workflow, execute_smart_deploy_workflow_batch, execute_health_check_workflow
 
 # We will mock the functions that these tools call.
 # The paths for patching are relative to where they are imported in 'agent.py'.
@@ -21,6 +22,13 @@ DA_DEPLOY = 'agent.deploy_to_cloud_run'
 MDA_GET_METRICS = 'agent.get_cloud_run_metrics'
 MDA_GET_LOGS = 'agent.get_cloud_run_logs'
 MDA_GENERATE_REPORT = 'agent.generate_health_report'
+MOA_SMART_DEPLOY = 'agent.execute_smart_deploy_workflow'
+
+
+@pytest.fixture(autouse=True)
+def clear_build_cache(mocker):
+    """Gives every test an empty build cache so results don't leak between tests."""
+    mocker.patch.dict('agent._BUILD_CACHE', clear=True)
 
 
 @patch(DA_DEPLOY)
@@ -69,6 +77,37 @@ def test_smart_deploy_workflow_success_path(
     mock_da_deploy.assert_called_once()
 
 
+@patch(DA_DEPLOY)
+@patch(SECOPS_SUMMARIZE)
+@patch(SECOPS_GET_RESULTS)
+@patch(BTA_TRIGGER_BUILD)
+@patch(SCA_LATEST_COMMIT)
+def test_smart_deploy_workflow_reuses_recent_build(
+    mock_sca_commit, mock_bta_build, mock_secops_scan, mock_secops_summary, mock_da_deploy
+):
+    """Tests that deploying the same commit twice only triggers one build."""
+    # --- Mock Setup ---
+    mock_sca_commit.return_value = {"status": "SUCCESS", "commit_sha": "abcdef123", "message": "SCA success"}
+    mock_bta_build.return_value = {
+        "status": "SUCCESS",
+        "message": "BTA success",
+        "image_uri_commit": "gcr.io/proj/img:abcdef123",
+        "details": {"results": {"images": []}},
+        "test_results": {"test_status": "PASSED", "failure_summary": "All tests passed."}
+    }
+    mock_da_deploy.return_value = {"status": "FAILURE", "error_message": "stop here"}
+
+    # --- Function Calls ---
+    with patch('agent.execute_rollback_workflow', return_value="rolled back"):
+        execute_smart_deploy_workflow("gemini-flow-hello-world", "main")
+        result = execute_smart_deploy_workflow("gemini-flow-hello-world", "main")
+
+    # --- Assertions ---
+    mock_bta_build.assert_called_once()
+    assert mock_da_deploy.call_count == 2
+    assert "2. BTA Report: BTA success" in result
+
+
 @patch(BTA_TRIGGER_BUILD)
 @patch(SCA_LATEST_COMMIT)
 def test_smart_deploy_workflow_bta_failure(mock_sca_commit, mock_bta_build):
@@ -87,6 +126,17 @@ def test_smart_deploy_workflow_bta_failure(mock_sca_commit, mock_bta_build):
     assert "3. Security Scan" not in result # Verify the next step was not reached
 
 
+@patch(SCA_LATEST_COMMIT)
+def test_smart_deploy_workflow_unsupported_app(mock_sca_commit):
+    """Tests that an unknown repository is rejected before any pipeline step runs."""
+    # --- Function Call ---
+    result = execute_smart_deploy_workflow("some-other-app", "main")
+
+    # --- Assertions ---
+    assert "'some-other-app' is not a supported application" in result
+    mock_sca_commit.assert_not_called()
+
+
 @patch(MDA_GENERATE_REPORT)
 @patch(MDA_GET_LOGS)
 @patch(MDA_GET_METRICS)
@@ -107,4 +157,50 @@ def test_health_check_workflow_success(mock_get_metrics, mock_get_logs, mock_gen
     assert result == "Formatted raw health data"
     mock_get_metrics.assert_called_once()
     mock_get_logs.assert_called_once()
-    mock_generate_report.assert_called_once()
\ No newline at end of file
+    mock_generate_report.assert_called_once()
+
+
+@patch(MOA_SMART_DEPLOY)
+def test_smart_deploy_workflow_batch_runs_each_target(mock_smart_deploy):
+    """Tests that the batch workflow deploys every target and reports failures per target."""
+    # --- Mock Setup ---
+    def fake_deploy(target_repository_name, target_branch_name):
+        if target_repository_name == "broken-app":
+            raise RuntimeError("boom")
+        return f"deployed {target_repository_name}@{target_branch_name}"
+    mock_smart_deploy.side_effect = fake_deploy
+
+    # --- Function Call ---
+    result = asyncio.run(execute_smart_deploy_workflow_batch([
+        {"repository": "gemini-flow-hello-world", "branch": "main"},
+        {"repository": "broken-app", "branch": "dev"},
+    ]))
+
+    # --- Assertions ---
+    assert mock_smart_deploy.call_count == 2
+    assert "=== gemini-flow-hello-world (main) ===\ndeployed gemini-flow-hello-world@main" in result
+    assert "=== broken-app (dev) ===" in result
+    assert "Workflow FAILED with an unexpected error: boom" in result
+
+
+@patch(MOA_SMART_DEPLOY)
+def test_smart_deploy_workflow_batch_skips_duplicate_targets(mock_smart_deploy):
+    """Tests that targets resolving to the same application deploy once and the repeats are reported as skipped."""
+    # --- Mock Setup ---
+    mock_smart_deploy.side_effect = lambda target_repository_name, target_branch_name: f"deployed {target_repository_name}@{target_branch_name}"
+
+    # --- Function Call ---
+    result = asyncio.run(execute_smart_deploy_workflow_batch([
+        {"repository": "gemini-flow-hello-world", "branch": "main"},
+        {"repository": "Gemini-Flow-Hello-World", "branch": "main"},
+        {"repository": "gemini-flow-hello-world", "branch": "dev"},
+        {"repository": "komfysach/gemini-flow-hello-world", "branch": "main"},
+    ]))
+
+    # --- Assertions ---
+    mock_smart_deploy.assert_called_once_with(
+        target_repository_name="gemini-flow-hello-world", target_branch_name="main"
+    )
+    assert "=== gemini-flow-hello-world (main) ===\ndeployed gemini-flow-hello-world@main" in result
+    assert result.count("Skipped: gemini-flow-hello-world (main) already deploys this application") == 3
+    assert "@dev" not in result
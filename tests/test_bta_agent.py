@@ -10,12 +10,14 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'multi_tool_agent')))
 
 from google.cloud.devtools import cloudbuild_v1
-from bta_agent import trigger_build_and_monitor
+from bta_agent import trigger_build_and_monitor, fetch_build_logs, _parse_go_test_json, _generate_summary, _summarize_test_failures_with_gemini
 
 # A fixture to provide a mock CloudBuildClient
 @pytest.fixture
 def mock_cloud_build_client(mocker):
     """Mocks the google.cloud.devtools.cloudbuild_v1.CloudBuildClient."""
+    # Reset the cached client so each test constructs it from the patched class
+    mocker.patch('bta_agent._BUILD_CLIENT', None)
     mock_client_class = mocker.patch('bta_agent.cloudbuild_v1.CloudBuildClient')
     mock_client_instance = MagicMock()
     mock_client_class.return_value = mock_client_instance
@@ -49,16 +51,15 @@ def test_trigger_build_success_with_passing_tests(mocker, mock_cloud_build_clien
     # Mock time.sleep to avoid delays in tests
     mocker.patch('time.sleep')
     
-    # Mock the helper functions for downloading and parsing test results
-    mocker.patch('bta_agent._download_gcs_artifact', return_value='{"Action":"pass"}')
-    mocker.patch('bta_agent._parse_go_test_json', return_value={
+    # Mock the helper that streams and parses test results from GCS
+    mocker.patch('bta_agent._load_go_test_results', return_value={
         "tests": 5, "failures": 0, "skipped": 0, "failure_details": []
     })
     mocker.patch('bta_agent._summarize_test_failures_with_gemini', return_value="All tests passed.")
     
     # Mock fetch_build_logs and summarize_build_logs_with_gemini
-    mocker.patch('bta_agent.fetch_build_logs', return_value="Build log content")
-    mocker.patch('bta_agent.summarize_build_logs_with_gemini', return_value="Build summary")
+    mock_fetch_logs = mocker.patch('bta_agent.fetch_build_logs', return_value="Build log content")
+    mock_summarize_logs = mocker.patch('bta_agent.summarize_build_logs_with_gemini', return_value="Build summary")
     
     # --- Function Call ---
     result = trigger_build_and_monitor(
@@ -75,6 +76,11 @@ def test_trigger_build_success_with_passing_tests(mocker, mock_cloud_build_clien
     assert result["test_results"]["test_status"] == "PASSED"
     assert result["test_results"]["tests_total"] == 5
     assert result["test_results"]["tests_failed"] == 0
+    assert result["image_uri_commit"].endswith("/gemini-flow-apps/gemini-flow-hello-world:abcdef12345")
+    assert "/test-project/" in result["image_uri_commit"]
+    # Green builds skip the log download and Gemini log summary
+    mock_fetch_logs.assert_not_called()
+    mock_summarize_logs.assert_not_called()
 
 def test_trigger_build_success_with_failing_tests(mocker, mock_cloud_build_client):
     """
@@ -101,8 +107,7 @@ def test_trigger_build_success_with_failing_tests(mocker, mock_cloud_build_clien
     mock_cloud_build_client.get_build.return_value = mock_build_result
     
     mocker.patch('time.sleep')
-    mocker.patch('bta_agent._download_gcs_artifact', return_value='{"Action":"fail"}')
-    mocker.patch('bta_agent._parse_go_test_json', return_value={
+    mocker.patch('bta_agent._load_go_test_results', return_value={
         "tests": 5, "failures": 1, "skipped": 0, "failure_details": [{"test_name": "TestFailing", "details": "Expected true, got false"}]
     })
     mocker.patch('bta_agent._summarize_test_failures_with_gemini', return_value="Gemini summary of the failure.")
@@ -138,7 +143,7 @@ def test_trigger_build_fails(mocker, mock_cloud_build_client):
     mock_cloud_build_client.get_build.return_value = mock_build_result
 
     mocker.patch('time.sleep')
-    mocker.patch('bta_agent._download_gcs_artifact', return_value=None)
+    mocker.patch('bta_agent._load_go_test_results', return_value=None)
     mocker.patch('bta_agent.extract_test_results', return_value={
         "test_status": "NO_TESTS",
         "message": "No test results found for this build."
@@ -152,4 +157,201 @@ def test_trigger_build_fails(mocker, mock_cloud_build_client):
     # --- Assertions ---
     assert result["status"] == "FAILURE"
     assert "Build failed with status: FAILURE" in result["error_message"]
-    assert "Build failure analysis" in result["error_message"]
\ No newline at end of file
+    assert "Build failure analysis" in result["error_message"]
+
+def test_trigger_build_fails_before_tests(mocker, mock_cloud_build_client):
+    """
+    Tests that a build failing before the test step reports NOT_RUN without fetching artifacts.
+    """
+    # --- Mock Setup ---
+    failed_step = MagicMock()
+    failed_step.id = "build-image"
+    failed_step.status = cloudbuild_v1.Build.Status.FAILURE
+    test_step = MagicMock()
+    test_step.id = "run-tests"
+    test_step.status = cloudbuild_v1.Build.Status.QUEUED
+
+    mock_build_result = MagicMock()
+    mock_build_result.status = cloudbuild_v1.Build.Status.FAILURE
+    mock_build_result.log_url = "gs://test-bucket/logs/build.log"
+    mock_build_result.steps = [failed_step, test_step]
+
+    mock_operation = MagicMock()
+    mock_operation.metadata.build.id = "mock_build_id_fail"
+    mock_cloud_build_client.run_build_trigger.return_value = mock_operation
+    mock_cloud_build_client.get_build.return_value = mock_build_result
+
+    mocker.patch('time.sleep')
+    mock_load = mocker.patch('bta_agent._load_go_test_results')
+    mocker.patch('bta_agent.fetch_build_logs', return_value="Build failed log content")
+    mocker.patch('bta_agent.summarize_build_logs_with_gemini', return_value="Build failure analysis")
+
+    # --- Function Call ---
+    result = trigger_build_and_monitor("t", "p", "r", "b", "c")
+
+    # --- Assertions ---
+    assert result["status"] == "FAILURE"
+    assert result["test_results"]["test_status"] == "NOT_RUN"
+    assert "build-image" in result["test_results"]["failure_summary"]
+    mock_load.assert_not_called()
+
+def test_parse_go_test_json_from_line_stream():
+    """
+    Tests that the parser consumes an iterator of lines, as yielded by a streamed GCS artifact.
+    """
+    # --- Mock Setup ---
+    lines = iter([
+        '{"Action":"run","Test":"TestOk"}\n',
+        '{"Action":"pass","Test":"TestOk"}\n',
+        '{"Action":"run","Test":"TestBad"}\n',
+        '{"Action":"output","Test":"TestBad","Output":"want 1, got 2\\n"}\n',
+        '{"Action":"fail","Test":"TestBad"}\n',
+        'not json\n',
+    ])
+
+    # --- Function Call ---
+    results = _parse_go_test_json(lines)
+
+    # --- Assertions ---
+    assert results["tests"] == 2
+    assert results["failures"] == 1
+    assert results["failure_details"][0]["test_name"] == "TestBad"
+    assert results["failure_details"][0]["details"] == "want 1, got 2"
+
+def test_generate_summary_reuses_identical_prompt(mocker):
+    """
+    Tests that a repeated prompt is answered from the summary cache without calling Gemini again.
+    """
+    # --- Mock Setup ---
+    mocker.patch.dict('bta_agent._SUMMARY_CACHE', clear=True)
+    mock_model = MagicMock()
+    mock_model.generate_content.return_value.text = "Summary"
+
+    # --- Function Call ---
+    first = _generate_summary(mock_model, "same prompt")
+    second = _generate_summary(mock_model, "same prompt")
+
+    # --- Assertions ---
+    assert first == second == "Summary"
+    mock_model.generate_content.assert_called_once_with("same prompt")
+
+def test_summarize_test_failures_caps_prompt(mocker):
+    """
+    Tests that only the first MAX_SUMMARIZED_FAILURES failures are sent, with a count of the rest.
+    """
+    # --- Mock Setup ---
+    mocker.patch.dict('bta_agent._SUMMARY_CACHE', clear=True)
+    mocker.patch('bta_agent.GCP_PROJECT_ID', 'test-project')
+    mocker.patch('bta_agent._get_genai', return_value=MagicMock())
+    mock_model = MagicMock()
+    mock_model.generate_content.return_value.text = "Summary"
+    mocker.patch('bta_agent._get_gemini_model', return_value=mock_model)
+    failures = [{"test_name": f"Test{i}", "details": f"boom {i}"} for i in range(30)]
+
+    # --- Function Call ---
+    summary = _summarize_test_failures_with_gemini(failures)
+
+    # --- Assertions ---
+    assert summary == "Summary"
+    prompt = mock_model.generate_content.call_args[0][0]
+    assert "Failure 20:" in prompt
+    assert "Failure 21:" not in prompt
+    assert "...and 10 more failures not shown." in prompt
+
+def test_summarize_test_failures_dedupes_identical_failures(mocker):
+    """
+    Tests that failures differing only in their go test framing lines and test name are sent to Gemini once with an occurrence count.
+    """
+    # --- Mock Setup ---
+    mocker.patch.dict('bta_agent._SUMMARY_CACHE', clear=True)
+    mocker.patch('bta_agent.GCP_PROJECT_ID', 'test-project')
+    mocker.patch('bta_agent._get_genai', return_value=MagicMock())
+    mock_model = MagicMock()
+    mock_model.generate_content.return_value.text = "Summary"
+    mocker.patch('bta_agent._get_gemini_model', return_value=mock_model)
+    lines = ['{"Action":"run","Test":"TestHandler"}\n']
+    for case in ("missing_id", "bad_id", "empty_body", "huge_body", "wrong_method"):
+        name = f"TestHandler/{case}"
+        lines += [
+            f'{{"Action":"run","Test":"{name}"}}\n',
+            f'{{"Action":"output","Test":"{name}","Output":"=== RUN   {name}\\n"}}\n',
+            f'{{"Action":"output","Test":"{name}","Output":"    handler_test.go:42: {name}: expected 200, got 500\\n"}}\n',
+            f'{{"Action":"output","Test":"{name}","Output":"    --- FAIL: {name} (0.00s)\\n"}}\n',
+            f'{{"Action":"fail","Test":"{name}","Elapsed":0}}\n',
+        ]
+    lines += [
+        '{"Action":"run","Test":"TestOther"}\n',
+        '{"Action":"output","Test":"TestOther","Output":"=== RUN   TestOther\\n"}\n',
+        '{"Action":"output","Test":"TestOther","Output":"    other_test.go:7: timeout\\n"}\n',
+        '{"Action":"output","Test":"TestOther","Output":"--- FAIL: TestOther (1.00s)\\n"}\n',
+        '{"Action":"fail","Test":"TestOther","Elapsed":1}\n',
+    ]
+    failures = _parse_go_test_json(lines)["failure_details"]
+
+    # --- Function Call ---
+    _summarize_test_failures_with_gemini(failures)
+
+    # --- Assertions ---
+    prompt = mock_model.generate_content.call_args[0][0]
+    assert prompt.count("expected 200, got 500") == 1
+    assert "Failure 1 (x5 occurrences):" in prompt
+    assert "Failure 2:" in prompt
+    assert "=== RUN" not in prompt and "--- FAIL" not in prompt
+    assert "more failures not shown" not in prompt
+
+def test_trigger_build_cancelled_after_tests_reports_unknown(mocker, mock_cloud_build_client):
+    """
+    Tests that a build cancelled after the test step does not claim the tests never ran.
+    """
+    # --- Mock Setup ---
+    test_step = MagicMock()
+    test_step.id = "run-tests"
+    test_step.status = cloudbuild_v1.Build.Status.SUCCESS
+    upload_step = MagicMock()
+    upload_step.id = "upload-test-results"
+    upload_step.status = cloudbuild_v1.Build.Status.CANCELLED
+
+    mock_build_result = MagicMock()
+    mock_build_result.status = cloudbuild_v1.Build.Status.CANCELLED
+    mock_build_result.log_url = "gs://test-bucket/logs/build.log"
+    mock_build_result.steps = [test_step, upload_step]
+
+    mock_operation = MagicMock()
+    mock_operation.metadata.build.id = "mock_build_id_cancelled"
+    mock_cloud_build_client.run_build_trigger.return_value = mock_operation
+    mock_cloud_build_client.get_build.return_value = mock_build_result
+
+    mocker.patch('time.sleep')
+    mocker.patch('bta_agent.fetch_build_logs', return_value="Build cancelled log content")
+    mocker.patch('bta_agent.summarize_build_logs_with_gemini', return_value="Build cancelled")
+
+    # --- Function Call ---
+    result = trigger_build_and_monitor("t", "p", "r", "b", "c")
+
+    # --- Assertions ---
+    assert result["status"] == "FAILURE"
+    assert result["test_results"]["test_status"] == "UNKNOWN"
+    assert "CANCELLED" in result["test_results"]["failure_summary"]
+
+
+def test_fetch_build_logs_keeps_the_end_of_a_long_log(mocker):
+    """Tests that a log longer than max_bytes is fetched as its head and its real tail, where the error is."""
+    # --- Mock Setup ---
+    log = b"Step #0: starting build\n" + b"Step #1: compiling...\n" * 1000 + b"ERROR: build step 2 exited with status 1\n"
+    mock_blob = MagicMock()
+    mock_blob.size = len(log)
+    mock_blob.download_as_bytes.side_effect = lambda start, end: log[start:end + 1]
+    mock_storage_client = mocker.patch('bta_agent._get_storage_client').return_value
+    mock_storage_client.bucket.return_value.get_blob.return_value = mock_blob
+
+    # --- Function Call ---
+    logs = fetch_build_logs("gs://test-bucket/logs/build.log", max_bytes=1000)
+
+    # --- Assertions ---
+    assert logs.startswith("Step #0: starting build")
+    assert logs.endswith("ERROR: build step 2 exited with status 1\n")
+    assert len(logs) <= 1000 + len("\n...\n")
+    assert [c.kwargs for c in mock_blob.download_as_bytes.call_args_list] == [
+        {"start": 0, "end": 499},
+        {"start": len(log) - 500, "end": len(log) - 1},
+    ]
@@ -2,17 +2,25 @@ import pytest
 from unittest.mock import MagicMock, patch
 import sys
 import os
+import asyncio
+import concurrent.futures
+import threading
+import time
 
 # Adjust the path to find your agent files
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'multi_tool_agent')))
 
 from google.cloud import run_v2
 from google.api_core import exceptions as api_exceptions
-from da_agent import deploy_to_cloud_run
+from da_agent import deploy_to_cloud_run, deploy_many
 
 @pytest.fixture
 def mock_cloud_run_client(mocker):
     """Mocks the google.cloud.run_v2.ServicesClient."""
+    # Reset the cached clients so each test constructs them from the patched class
+    mocker.patch.dict('da_agent._SERVICES_CLIENTS', clear=True)
+    mocker.patch.dict('da_agent._PUBLIC_SERVICE_CACHE', clear=True)
+    mocker.patch.dict('da_agent._DEPLOYED_IMAGES', clear=True)
     mock_client_class = mocker.patch('da_agent.run_v2.ServicesClient')
     mock_client_instance = MagicMock()
     mock_client_class.return_value = mock_client_instance
@@ -33,8 +41,8 @@ def test_deploy_to_cloud_run_missing_parameters():
 
 def test_deploy_to_cloud_run_creates_new_service(mock_cloud_run_client, mocker):
     """Tests the flow when the service does not exist and needs to be created."""
-    # Mock get_service to raise NotFound, triggering the create flow
-    mock_cloud_run_client.get_service.side_effect = api_exceptions.NotFound("Service not found")
+    # Mock update_service to raise NotFound, triggering the create flow
+    mock_cloud_run_client.update_service.side_effect = api_exceptions.NotFound("Service not found")
     
     # Create a proper service mock with all required attributes
     mock_service = MagicMock()
@@ -80,11 +88,6 @@ def test_deploy_to_cloud_run_creates_new_service(mock_cloud_run_client, mocker):
 
 def test_deploy_to_cloud_run_updates_existing_service(mock_cloud_run_client, mocker):
     """Tests the flow when the service already exists and needs to be updated."""
-    # Mock get_service to return an existing service
-    mock_existing_service = MagicMock()
-    mock_existing_service.name = "projects/test-project/locations/us-central1/services/existing-service"
-    mock_cloud_run_client.get_service.return_value = mock_existing_service
-
     # Create the updated service object
     mock_service = MagicMock()
     mock_service.name = "projects/test-project/locations/us-central1/services/existing-service"
@@ -126,11 +129,14 @@ def test_deploy_to_cloud_run_updates_existing_service(mock_cloud_run_client, moc
     assert "updated successfully" in result["message"]
     assert result["service_url"] == "https://existing-service-456-uc.a.run.app"
     assert result["service_name"] == "existing-service"
+    # The update is attempted directly, without an existence probe
+    mock_cloud_run_client.get_service.assert_not_called()
+    mock_cloud_run_client.create_service.assert_not_called()
 
 def test_deploy_to_cloud_run_service_already_public(mock_cloud_run_client, mocker):
     """Tests the flow when the service is already publicly accessible."""
-    # Mock get_service to raise NotFound
-    mock_cloud_run_client.get_service.side_effect = api_exceptions.NotFound("Service not found")
+    # Mock update_service to raise NotFound
+    mock_cloud_run_client.update_service.side_effect = api_exceptions.NotFound("Service not found")
     
     # Create the service object
     mock_service = MagicMock()
@@ -171,8 +177,8 @@ def test_deploy_to_cloud_run_service_already_public(mock_cloud_run_client, mocke
 
 def test_deploy_to_cloud_run_permission_denied_error(mock_cloud_run_client):
     """Tests handling of permission denied errors."""
-    # Mock get_service to raise PermissionDenied
-    mock_cloud_run_client.get_service.side_effect = api_exceptions.PermissionDenied("403 Permission denied")
+    # Mock update_service to raise PermissionDenied
+    mock_cloud_run_client.update_service.side_effect = api_exceptions.PermissionDenied("403 Permission denied")
 
     # Call the function
     result = deploy_to_cloud_run(
@@ -191,8 +197,8 @@ def test_deploy_to_cloud_run_permission_denied_error(mock_cloud_run_client):
 
 def test_deploy_to_cloud_run_operation_timeout(mock_cloud_run_client):
     """Tests handling of operation timeout."""
-    # Mock get_service to raise NotFound
-    mock_cloud_run_client.get_service.side_effect = api_exceptions.NotFound("Service not found")
+    # Mock update_service to raise NotFound
+    mock_cloud_run_client.update_service.side_effect = api_exceptions.NotFound("Service not found")
     
     # Mock the create_service operation to timeout
     mock_operation = MagicMock()
@@ -211,4 +217,181 @@ def test_deploy_to_cloud_run_operation_timeout(mock_cloud_run_client):
     assert result["status"] == "FAILURE"
     assert result["service_name"] == "timeout-service"
     assert "An unexpected error occurred" in result["error_message"]
-    assert "Operation timed out" in result["error_message"]
\ No newline at end of file
+    assert "Operation timed out" in result["error_message"]
+
+def test_deploy_to_cloud_run_deadline_exceeded(mock_cloud_run_client):
+    """Tests that hitting the rollout deadline is reported as such rather than as an unexpected error."""
+    mock_operation = MagicMock()
+    mock_operation.result.side_effect = concurrent.futures.TimeoutError()
+    mock_cloud_run_client.update_service.return_value = mock_operation
+
+    # Call the function
+    result = deploy_to_cloud_run(
+        project_id="test-project",
+        region="us-central1",
+        service_name="slow-service",
+        image_uri="gcr.io/test/image:latest"
+    )
+
+    # Assertions
+    assert result["status"] == "FAILURE"
+    assert "did not finish within" in result["error_message"]
+    assert "may still complete" in result["error_message"]
+
+def test_deploy_to_cloud_run_skips_iam_check_for_recently_public_service(mock_cloud_run_client, mocker):
+    """Tests that a redeploy skips the IAM policy read once the service is known to be public."""
+    mock_service = MagicMock()
+    mock_service.name = "projects/test-project/locations/us-central1/services/public-service"
+    mock_service.uri = "https://public-service-789-uc.a.run.app"
+    mock_service.ingress = run_v2.types.IngressTraffic.INGRESS_TRAFFIC_ALL
+    mock_operation = MagicMock()
+    mock_operation.result.return_value = mock_service
+    mock_cloud_run_client.update_service.return_value = mock_operation
+
+    mock_binding = MagicMock()
+    mock_binding.role = "roles/run.invoker"
+    mock_binding.members = ["allUsers"]
+    mock_policy = MagicMock()
+    mock_policy.bindings = [mock_binding]
+    mock_cloud_run_client.get_iam_policy.return_value = mock_policy
+    mocker.patch('da_agent.iam_policy_pb2.GetIamPolicyRequest', return_value=MagicMock())
+
+    # Deploy the same service twice
+    for _ in range(2):
+        result = deploy_to_cloud_run(
+            project_id="test-project",
+            region="us-central1",
+            service_name="public-service",
+            image_uri="gcr.io/test/image:latest"
+        )
+        assert result["status"] == "SUCCESS"
+
+    # Assertions
+    mock_cloud_run_client.get_iam_policy.assert_called_once()
+    mock_cloud_run_client.set_iam_policy.assert_not_called()
+
+def test_deploy_to_cloud_run_skips_rollout_for_unchanged_image(mock_cloud_run_client, mocker):
+    """Tests that redeploying the image already serving all traffic does not roll out a new revision."""
+    image_uri = "gcr.io/test/image:abc123"
+    mock_service = MagicMock()
+    mock_service.name = "projects/test-project/locations/us-central1/services/steady-service"
+    mock_service.uri = "https://steady-service-789-uc.a.run.app"
+    mock_operation = MagicMock()
+    mock_operation.result.return_value = mock_service
+    mock_cloud_run_client.update_service.return_value = mock_operation
+
+    # The live service still runs the same image with all traffic on the latest ready revision
+    mock_existing = MagicMock()
+    mock_existing.name = mock_service.name
+    mock_existing.uri = mock_service.uri
+    mock_existing.template.containers = [MagicMock(image=image_uri)]
+    mock_existing.ingress = run_v2.types.IngressTraffic.INGRESS_TRAFFIC_ALL
+    mock_existing.latest_ready_revision = "steady-service-00001"
+    mock_existing.latest_created_revision = "steady-service-00001"
+    mock_existing.traffic_statuses = [
+        MagicMock(type_=run_v2.types.TrafficTargetAllocationType.TRAFFIC_TARGET_ALLOCATION_TYPE_LATEST)
+    ]
+    mock_cloud_run_client.get_service.return_value = mock_existing
+    mocker.patch('da_agent._is_known_public', return_value=True)
+
+    # --- Function Call ---
+    first = deploy_to_cloud_run("test-project", "us-central1", "steady-service", image_uri)
+    second = deploy_to_cloud_run("test-project", "us-central1", "steady-service", image_uri)
+
+    # --- Assertions ---
+    assert first["status"] == "SUCCESS"
+    assert second["status"] == "SUCCESS"
+    assert "no new revision was rolled out" in second["message"]
+    assert second["service_url"] == "https://steady-service-789-uc.a.run.app"
+    mock_cloud_run_client.update_service.assert_called_once()
+    mock_cloud_run_client.get_service.assert_called_once()
+    # The existence read only asks for the fields the no-op check compares
+    fieldmask = dict(mock_cloud_run_client.get_service.call_args.kwargs["metadata"])["x-goog-fieldmask"]
+    assert "template.containers.image" in fieldmask
+
+def test_get_services_client_uses_regional_endpoint(mocker):
+    """Tests that Services clients are cached per region and target the regional endpoint."""
+    mocker.patch.dict('da_agent._SERVICES_CLIENTS', clear=True)
+    mock_client_class = mocker.patch('da_agent.run_v2.ServicesClient')
+
+    from da_agent import _get_services_client
+    first = _get_services_client("europe-west1")
+    again = _get_services_client("europe-west1")
+    _get_services_client("us-central1")
+
+    assert first is again
+    assert mock_client_class.call_count == 2
+    endpoints = [c.kwargs["client_options"].api_endpoint for c in mock_client_class.call_args_list]
+    assert endpoints == ["europe-west1-run.googleapis.com", "us-central1-run.googleapis.com"]
+
+def test_deploy_many_caps_concurrency_and_preserves_order(mocker):
+    """Tests that batch deploys run side by side up to the limit and report per service in order."""
+    # --- Mock Setup ---
+    lock = threading.Lock()
+    in_flight = {"now": 0, "peak": 0}
+
+    def fake_deploy(project_id, region, service_name, image_uri):
+        with lock:
+            in_flight["now"] += 1
+            in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+        time.sleep(0.05)
+        with lock:
+            in_flight["now"] -= 1
+        if service_name == "bad-service":
+            raise RuntimeError("boom")
+        return {"status": "SUCCESS", "service_name": service_name}
+
+    mocker.patch('da_agent.deploy_to_cloud_run', side_effect=fake_deploy)
+    specs = [
+        {"project_id": "p", "region": "us-central1", "service_name": f"svc-{i}", "image_uri": "img:1"}
+        for i in range(5)
+    ]
+    specs.append({"project_id": "p", "region": "us-central1", "service_name": "bad-service", "image_uri": "img:1"})
+
+    # --- Function Call ---
+    results = asyncio.run(deploy_many(specs, max_concurrency=2))
+
+    # --- Assertions ---
+    assert [r["service_name"] for r in results] == [s["service_name"] for s in specs]
+    assert all(r["status"] == "SUCCESS" for r in results[:5])
+    assert results[5]["status"] == "FAILURE"
+    assert "boom" in results[5]["error_message"]
+    assert in_flight["peak"] == 2
+
+def test_deploy_many_rejects_duplicate_service_specs(mocker):
+    """Tests that a second spec for the same service is not deployed concurrently with the first."""
+    # --- Mock Setup ---
+    mock_deploy = mocker.patch(
+        'da_agent.deploy_to_cloud_run',
+        side_effect=lambda **spec: {"status": "SUCCESS", "service_name": spec["service_name"]},
+    )
+    specs = [
+        {"project_id": "p", "region": "us-central1", "service_name": "svc", "image_uri": "img:1"},
+        {"project_id": "p", "region": "us-central1", "service_name": "svc", "image_uri": "img:2"},
+        {"project_id": "p", "region": "europe-west1", "service_name": "svc", "image_uri": "img:1"},
+    ]
+
+    # --- Function Call ---
+    results = asyncio.run(deploy_many(specs))
+
+    # --- Assertions ---
+    assert mock_deploy.call_count == 2
+    assert results[0]["status"] == "SUCCESS"
+    assert results[1]["status"] == "ERROR"
+    assert "Duplicate deploy for service 'svc'" in results[1]["error_message"]
+    assert results[2]["status"] == "SUCCESS"
+    deployed_images = sorted(c.kwargs["image_uri"] for c in mock_deploy.call_args_list)
+    assert deployed_images == ["img:1", "img:1"]
+
+def test_deploy_many_reports_cancelled_deploy_as_failure(mocker):
+    """Tests that a deploy cancelled mid-batch comes back as a FAILURE dict, not a raw CancelledError."""
+    # --- Mock Setup ---
+    mocker.patch('da_agent.deploy_to_cloud_run', side_effect=asyncio.CancelledError())
+    specs = [{"project_id": "p", "region": "us-central1", "service_name": "svc", "image_uri": "img:1"}]
+
+    # --- Function Call ---
+    results = asyncio.run(deploy_many(specs))
+
+    # --- Assertions ---
+    assert results[0]["status"] == "FAILURE"
+    assert "CancelledError" in results[0]["error_message"]
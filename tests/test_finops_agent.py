@@ -8,11 +8,14 @@ import sys
 import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'multi_tool_agent')))
 
-from finops_agent import get_total_project_cost, get_cost_by_service
+from finops_agent import get_total_project_cost, get_cost_by_service, get_cost_summary
 
 @pytest.fixture
 def mock_bigquery_client(mocker):
     """Mocks the google.cloud.bigquery.Client."""
+    # Reset the cached clients so each test constructs one from the patched class
+    mocker.patch.dict('finops_agent._BQ_CLIENTS', clear=True)
+    mocker.patch.dict('finops_agent._COST_SUMMARY_CACHE', clear=True)
     mock_client_class = mocker.patch('finops_agent.bigquery.Client')
     mock_client_instance = MagicMock()
     mock_client_class.return_value = mock_client_instance
@@ -27,6 +30,7 @@ def test_get_total_project_cost_success(mocker, mock_bigquery_client):
     
     # Simulate the BigQuery result
     mock_row = MagicMock()
+    mock_row.kind = "total"
     mock_row.total_cost = 123.45
     mock_query_job = MagicMock()
     mock_query_job.result.return_value = [mock_row]
@@ -49,15 +53,21 @@ def test_get_cost_by_service_success(mocker, mock_bigquery_client):
     mocker.patch('finops_agent.GCP_PROJECT_ID', 'test-project')
 
     # Simulate the BigQuery result with multiple rows
+    mock_total_row = MagicMock()
+    mock_total_row.kind = "total"
+    mock_total_row.total_cost = 75.75
     mock_row1 = MagicMock()
+    mock_row1.kind = "service"
     mock_row1.service_name = "Cloud Run"
     mock_row1.total_cost = 50.25
     mock_row2 = MagicMock()
+    mock_row2.kind = "service"
     mock_row2.service_name = "Cloud Build"
     mock_row2.total_cost = 25.50
     
     mock_query_job = MagicMock()
-    mock_query_job.result.return_value = [mock_row1, mock_row2]
+    # UNION ALL may return the service rows in any order
+    mock_query_job.result.return_value = [mock_row2, mock_total_row, mock_row1]
     mock_bigquery_client.query.return_value = mock_query_job
     
     # --- Function Call ---
@@ -72,6 +82,101 @@ def test_get_cost_by_service_success(mocker, mock_bigquery_client):
     assert result["cost_breakdown"][1]["total_cost"] == "$25.50"
     mock_bigquery_client.query.assert_called_once()
 
+def test_get_cost_summary_uses_single_query(mocker, mock_bigquery_client):
+    """Tests that the total and per-service breakdown come from one BigQuery job."""
+    # --- Mock Setup ---
+    mocker.patch('finops_agent.BIGQUERY_BILLING_TABLE', 'mock.billing.table')
+    mocker.patch('finops_agent.GCP_PROJECT_ID', 'test-project')
+
+    mock_total_row = MagicMock()
+    mock_total_row.kind = "total"
+    mock_total_row.total_cost = 80.0
+    mock_service_row = MagicMock()
+    mock_service_row.kind = "service"
+    mock_service_row.service_name = "Cloud Run"
+    mock_service_row.total_cost = 80.0
+
+    mock_query_job = MagicMock()
+    mock_query_job.result.return_value = [mock_total_row, mock_service_row]
+    mock_bigquery_client.query.return_value = mock_query_job
+
+    # --- Function Call ---
+    result = get_cost_summary(days_ago=7, limit=3)
+
+    # --- Assertions ---
+    assert result["status"] == "SUCCESS"
+    assert result["total_cost"] == "$80.00"
+    assert result["cost_breakdown"] == [{"service_name": "Cloud Run", "total_cost": "$80.00"}]
+    mock_bigquery_client.query.assert_called_once()
+    assert "WITH filtered AS" in mock_bigquery_client.query.call_args.args[0]
+    # One total row plus at most `limit` service rows
+    mock_query_job.result.assert_called_once_with(max_results=4)
+
+
+def test_get_cost_summary_prunes_partitions(mocker, mock_bigquery_client):
+    """Tests that the query filters on _PARTITIONTIME with a typed TIMESTAMP parameter."""
+    # --- Mock Setup ---
+    mocker.patch('finops_agent.BIGQUERY_BILLING_TABLE', 'mock.billing.table')
+    mocker.patch('finops_agent.GCP_PROJECT_ID', 'test-project')
+    mock_bigquery_client.query.return_value.result.return_value = []
+
+    # --- Function Call ---
+    result = get_cost_summary(days_ago=3)
+
+    # --- Assertions ---
+    assert result["status"] == "SUCCESS"
+    query, kwargs = mock_bigquery_client.query.call_args.args[0], mock_bigquery_client.query.call_args.kwargs
+    assert "_PARTITIONTIME >= TIMESTAMP_TRUNC(@start_date, DAY)" in query
+    params = {p.name: p for p in kwargs["job_config"].query_parameters}
+    assert params["start_date"].type_ == "TIMESTAMP"
+
+
+def test_get_cost_summary_serves_repeat_calls_from_cache(mocker, mock_bigquery_client):
+    """Tests that identical requests within the TTL reuse the first query's result."""
+    # --- Mock Setup ---
+    mocker.patch('finops_agent.BIGQUERY_BILLING_TABLE', 'mock.billing.table')
+    mocker.patch('finops_agent.GCP_PROJECT_ID', 'test-project')
+    mock_total_row = MagicMock()
+    mock_total_row.kind = "total"
+    mock_total_row.total_cost = 10.0
+    mock_bigquery_client.query.return_value.result.return_value = [mock_total_row]
+
+    # --- Function Call ---
+    first = get_cost_summary(days_ago=7, limit=5)
+    second = get_total_project_cost(days_ago=7)
+    other_window = get_cost_summary(days_ago=30, limit=5)
+
+    # --- Assertions ---
+    assert first["total_cost"] == second["total_cost"] == "$10.00"
+    assert other_window["status"] == "SUCCESS"
+    # The 7-day summary is cached; only the 30-day window triggers a second query
+    assert mock_bigquery_client.query.call_count == 2
+
+
+def test_get_cost_summary_cached_breakdown_is_not_shared(mocker, mock_bigquery_client):
+    """Tests that changing a returned breakdown does not alter what later calls get from the cache."""
+    # --- Mock Setup ---
+    mocker.patch('finops_agent.BIGQUERY_BILLING_TABLE', 'mock.billing.table')
+    mocker.patch('finops_agent.GCP_PROJECT_ID', 'test-project')
+    mock_total_row = MagicMock()
+    mock_total_row.kind = "total"
+    mock_total_row.total_cost = 80.0
+    mock_service_row = MagicMock()
+    mock_service_row.kind = "service"
+    mock_service_row.service_name = "Cloud Run"
+    mock_service_row.total_cost = 80.0
+    mock_bigquery_client.query.return_value.result.return_value = [mock_total_row, mock_service_row]
+
+    # --- Function Call ---
+    first = get_cost_summary(days_ago=7, limit=5)
+    first["cost_breakdown"].append({"service_name": "Injected", "total_cost": "$0.00"})
+    first["cost_breakdown"][0]["total_cost"] = "$0.00"
+    second = get_cost_summary(days_ago=7, limit=5)
+
+    # --- Assertions ---
+    assert second["cost_breakdown"] == [{"service_name": "Cloud Run", "total_cost": "$80.00"}]
+    mock_bigquery_client.query.assert_called_once()
+
 
 def test_get_total_project_cost_no_config(mocker):
     """Tests that the cost functions fail gracefully if config is missing."""
@@ -6,6 +6,8 @@ from unittest.mock import MagicMock, patch
 # Adjust the path to find your agent files
 import sys
 import os
+import gzip
+import concurrent.futures
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'multi_tool_agent')))
 
 from infra_agent import (
@@ -13,13 +15,17 @@ from infra_agent import (
     run_terraform_apply, 
     _parse_terraform_log,
     _get_build_logs,
-    _save_log_archive
+    _save_log_archive,
+    _summarize_terraform_output_with_gemini
 )
 from google.cloud.devtools import cloudbuild_v1
+from google.api_core import exceptions as api_exceptions
 
 @pytest.fixture
 def mock_cloud_build_client(mocker):
     """Mocks the google.cloud.devtools.cloudbuild_v1.CloudBuildClient."""
+    # Reset the cached client so each test constructs it from the patched class
+    mocker.patch('infra_agent._BUILD_CLIENT', None)
     mock_client_class = mocker.patch('infra_agent.cloudbuild_v1.CloudBuildClient')
     mock_client_instance = MagicMock()
     mock_client_class.return_value = mock_client_instance
@@ -28,6 +34,7 @@ def mock_cloud_build_client(mocker):
 @pytest.fixture
 def mock_storage_client(mocker):
     """Mocks the google.cloud.storage.Client."""
+    mocker.patch('infra_agent._STORAGE_CLIENT', None)
     mock_storage_client_class = mocker.patch('infra_agent.storage.Client')
     mock_storage_client_instance = MagicMock()
     mock_storage_client_class.return_value = mock_storage_client_instance
@@ -51,9 +58,9 @@ def test_run_terraform_plan_success(mocker, mock_cloud_build_client):
     mock_cloud_build_client.run_build_trigger.return_value = mock_operation
     
     # Mock the NEW log retrieval function
-    mock_log_content = "Plan: 2 to add, 1 to change, 0 to destroy."
+    mock_log_content = b"Plan: 2 to add, 1 to change, 0 to destroy."
     mocker.patch('infra_agent._get_build_logs', return_value=mock_log_content)
-    mocker.patch('infra_agent._save_log_archive')
+    mock_save = mocker.patch('infra_agent._save_log_archive')
     mocker.patch('infra_agent._summarize_terraform_output_with_gemini', return_value="AI summary of terraform plan")
 
     # --- Function Call ---
@@ -67,6 +74,8 @@ def test_run_terraform_plan_success(mocker, mock_cloud_build_client):
     assert result["status"] == "SUCCESS"
     assert "Terraform Plan Summary: 2 to add, 1 to change, 0 to destroy." in result["message"]
     assert result["log_retrieved"] == True
+    # The archive is written from the raw downloaded bytes
+    mock_save.assert_called_once_with(mock_log_content, "build-12345", "plan")
     
     # Verify the trigger was called with the correct substitutions
     call_kwargs = mock_cloud_build_client.run_build_trigger.call_args.kwargs
@@ -86,7 +95,7 @@ def test_run_terraform_apply_success(mocker, mock_cloud_build_client):
     mock_operation.result.return_value = mock_build_result
     mock_cloud_build_client.run_build_trigger.return_value = mock_operation
     
-    mock_log_content = 'Outputs:\n\nservice_url = "https://prod-test-123-uc.a.run.app"'
+    mock_log_content = b'Outputs:\n\nservice_url = "https://prod-test-123-uc.a.run.app"'
     mocker.patch('infra_agent._get_build_logs', return_value=mock_log_content)
     mocker.patch('infra_agent._save_log_archive')
     mocker.patch('infra_agent._summarize_terraform_output_with_gemini', return_value="AI summary of terraform apply")
@@ -116,7 +125,7 @@ def test_run_terraform_build_fails(mocker, mock_cloud_build_client):
     mock_operation.result.return_value = mock_build_result
     mock_cloud_build_client.run_build_trigger.return_value = mock_operation
     
-    mocker.patch('infra_agent._get_build_logs', return_value="Terraform failed with errors")
+    mocker.patch('infra_agent._get_build_logs', return_value=b"Terraform failed with errors")
     mocker.patch('infra_agent._save_log_archive')
     mocker.patch('infra_agent._summarize_terraform_output_with_gemini', return_value="AI analysis of failure")
 
@@ -160,9 +169,12 @@ def test_get_build_logs_success_with_retry(mocker, mock_storage_client):
     
     mock_bucket = MagicMock()
     mock_blob = MagicMock()
-    # Fail the first two existence checks, then succeed
-    mock_blob.exists.side_effect = [False, False, True]
-    mock_blob.download_as_text.return_value = "Log content"
+    # The first two downloads find no object yet, then the log appears
+    mock_blob.download_as_bytes.side_effect = [
+        api_exceptions.NotFound("No such object"),
+        api_exceptions.NotFound("No such object"),
+        b"Log content",
+    ]
     mock_bucket.blob.return_value = mock_blob
     mock_storage_client.bucket.return_value = mock_bucket
 
@@ -170,10 +182,15 @@ def test_get_build_logs_success_with_retry(mocker, mock_storage_client):
     log_content = _get_build_logs(mock_build_result)
 
     # --- Assertions ---
-    assert log_content == "Log content"
-    assert mock_blob.exists.call_count == 3
+    assert log_content == b"Log content"
+    assert mock_blob.download_as_bytes.call_count == 3
+    mock_blob.exists.assert_not_called()
     # Verify sleep was called 2 times (for the first 2 failed attempts)
     assert mock_sleep.call_count == 2
+    # The waits back off from roughly 1s to 2s (+/-20% jitter)
+    first_wait, second_wait = (c.args[0] for c in mock_sleep.call_args_list)
+    assert 0.8 <= first_wait <= 1.2
+    assert 1.6 <= second_wait <= 2.4
 
 def test_get_build_logs_fails_after_retries(mocker, mock_storage_client):
     """Tests that _get_build_logs returns None if the log never appears."""
@@ -186,8 +203,8 @@ def test_get_build_logs_fails_after_retries(mocker, mock_storage_client):
     
     mock_bucket = MagicMock()
     mock_blob = MagicMock()
-    # Always fail the existence check
-    mock_blob.exists.return_value = False
+    # The log object never appears
+    mock_blob.download_as_bytes.side_effect = api_exceptions.NotFound("No such object")
     mock_bucket.blob.return_value = mock_blob
     mock_storage_client.bucket.return_value = mock_bucket
 
@@ -196,8 +213,9 @@ def test_get_build_logs_fails_after_retries(mocker, mock_storage_client):
 
     # --- Assertions ---
     assert log_content is None
-    assert mock_blob.exists.call_count == 6 # It should try 6 times
-    assert mock_sleep.call_count == 6 # Should sleep 6 times (after each failed attempt)
+    # Waits of 1, 2, 4, 8, 15, 15, 15 seconds use up the 60s budget, then one last check
+    assert mock_blob.download_as_bytes.call_count == 8
+    assert mock_sleep.call_count == 7
 
 def test_get_build_logs_invalid_logs_bucket(mocker):
     """Tests _get_build_logs with invalid logs_bucket path."""
@@ -222,12 +240,15 @@ def test_save_log_archive_success(mocker, mock_storage_client):
     mock_storage_client.bucket.return_value = mock_bucket
 
     # --- Function Call ---
-    _save_log_archive("log content", "build-123", "plan")
+    _save_log_archive(b"log content", "build-123", "plan")
 
     # --- Assertions ---
     mock_storage_client.bucket.assert_called_with("test-archive-bucket")
     mock_bucket.blob.assert_called_with("terraform-logs/plan/build-123/terraform_log.txt")
-    mock_blob.upload_from_string.assert_called_with("log content")
+    uploaded = mock_blob.upload_from_string.call_args
+    assert gzip.decompress(uploaded.args[0]) == b"log content"
+    assert uploaded.kwargs["content_type"] == "text/plain; charset=utf-8"
+    assert mock_blob.content_encoding == "gzip"
 
 def test_save_log_archive_no_bucket_configured(mocker):
     """Tests _save_log_archive when TERRAFORM_LOGS_BUCKET is not set."""
@@ -235,7 +256,7 @@ def test_save_log_archive_no_bucket_configured(mocker):
     mocker.patch('infra_agent.TERRAFORM_LOGS_BUCKET', None)
 
     # --- Function Call ---
-    _save_log_archive("log content", "build-123", "plan")
+    _save_log_archive(b"log content", "build-123", "plan")
 
     # --- Assertions ---
     # Should not raise an exception, just log a warning
@@ -248,7 +269,7 @@ def test_save_log_archive_failure(mocker, mock_storage_client):
     mock_storage_client.bucket.side_effect = Exception("Storage error")
 
     # --- Function Call ---
-    _save_log_archive("log content", "build-123", "plan")
+    _save_log_archive(b"log content", "build-123", "plan")
 
     # --- Assertions ---
     # Should not raise an exception, just log the error
@@ -283,6 +304,23 @@ def test_parse_terraform_log_apply_successful_no_url():
     result = _parse_terraform_log(log_text, "apply -auto-approve")
     assert result == "Terraform apply completed successfully, but service_url output could not be parsed from logs."
 
+def test_parse_terraform_log_plan_summary_in_long_log():
+    """Tests that the plan summary is found at the end of a log longer than the tail window."""
+    log_text = "Refreshing state...\n" * 5000 + "Plan: 1 to add, 0 to change, 0 to destroy.\n"
+    result = _parse_terraform_log(log_text, "plan")
+    assert result == "Terraform Plan Summary: 1 to add, 0 to change, 0 to destroy."
+
+def test_parse_terraform_log_apply_uses_final_outputs_block():
+    """Tests that the service URL is read from the last Outputs: block of the apply log."""
+    log_text = (
+        'Changes to Outputs:\n  + service_url = (known after apply)\n'
+        + "Creating...\n" * 2000
+        + 'Apply complete! Resources: 1 added, 0 changed, 0 destroyed.\n\nOutputs:\n\n'
+        + 'service_url = "https://final-service-uc.a.run.app"\n'
+    )
+    result = _parse_terraform_log(log_text, "apply -auto-approve")
+    assert result == "Terraform apply complete. New service URL: https://final-service-uc.a.run.app"
+
 def test_parse_terraform_log_unknown_command():
     """Tests parsing with unknown command."""
     result = _parse_terraform_log("some log", "unknown")
@@ -293,6 +331,25 @@ def test_parse_terraform_log_empty():
     result = _parse_terraform_log("", "plan")
     assert result == "Could not retrieve logs to parse for Terraform plan result."
 
+def test_summarize_terraform_output_reuses_cached_summary(mocker):
+    """Tests that summarizing the same log twice calls Gemini once, using the log's tail."""
+    # --- Mock Setup ---
+    mocker.patch.dict('infra_agent._SUMMARY_CACHE', clear=True)
+    mock_genai = MagicMock()
+    mock_genai.GenerativeModel.return_value.generate_content.return_value.text = "Plan adds one service."
+    mocker.patch('infra_agent._get_gemini_client', return_value=mock_genai)
+    log_text = "x" * 5000 + "Plan: 1 to add, 0 to change, 0 to destroy."
+
+    # --- Function Call ---
+    first = _summarize_terraform_output_with_gemini(log_text, "plan")
+    second = _summarize_terraform_output_with_gemini(log_text, "plan")
+
+    # --- Assertions ---
+    assert first == second == "Plan adds one service."
+    generate = mock_genai.GenerativeModel.return_value.generate_content
+    generate.assert_called_once()
+    assert "Plan: 1 to add" in generate.call_args.args[0]
+
 def test_run_terraform_exception_handling(mocker, mock_cloud_build_client):
     """Tests exception handling when Cloud Build trigger fails."""
     # --- Mock Setup ---
@@ -308,4 +365,19 @@ def test_run_terraform_exception_handling(mocker, mock_cloud_build_client):
     # --- Assertions ---
     assert result["status"] == "ERROR"
     assert "Failed to run Terraform trigger" in result["error_message"]
-    assert "Trigger not found" in result["error_message"]
\ No newline at end of file
+    assert "Trigger not found" in result["error_message"]
+
+def test_run_terraform_build_deadline_exceeded(mocker, mock_cloud_build_client):
+    """Tests that a Terraform build outlasting the deadline is reported as such."""
+    # --- Mock Setup ---
+    mock_operation = MagicMock()
+    mock_operation.result.side_effect = concurrent.futures.TimeoutError()
+    mock_cloud_build_client.run_build_trigger.return_value = mock_operation
+
+    # --- Function Call ---
+    result = run_terraform_apply("slow-service", "gcr.io/test/image:latest", timeout_seconds=42)
+
+    # --- Assertions ---
+    assert result["status"] == "FAILURE"
+    assert "did not finish within 42 seconds" in result["error_message"]
+    mock_operation.result.assert_called_once_with(timeout=42)
@@ -23,10 +23,11 @@ def mock_container_analysis_client(mocker):
 
 @pytest.fixture
 def mock_gemini_model(mocker):
-    """Mocks the google.generativeai.GenerativeModel."""
-    mock_model_class = mocker.patch('secops_agent.genai.GenerativeModel')
+    """Mocks the lazily imported google.generativeai module and its GenerativeModel."""
+    mock_genai = MagicMock()
+    mocker.patch('secops_agent._get_genai', return_value=mock_genai)
     mock_model_instance = MagicMock()
-    mock_model_class.return_value = mock_model_instance
+    mock_genai.GenerativeModel.return_value = mock_model_instance
     return mock_model_instance
 
 def test_get_vulnerability_scan_results_success(mocker, mock_container_analysis_client):